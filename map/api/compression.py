@@ -0,0 +1,88 @@
+"""Response compression for the API blueprint
+
+Negotiated from the client's ``Accept-Encoding``, ``br`` is preferred when
+the optional ``brotli`` package is installed, else ``gzip``.  Streamed
+responses are compressed chunk by chunk as they're generated.
+"""
+import gzip
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+SUPPORTED_ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+COMPRESSIBLE_TYPES = ('application/json', 'application/fhir+json')
+# gzip's highest level; brotli qualities run higher, to 11
+MAX_GZIP_LEVEL = 9
+
+
+def accepted_encoding(supported=SUPPORTED_ENCODINGS):
+    """Return first of supported encodings acceptable to client, if any"""
+    for encoding in supported:
+        if request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+def compressor(encoding, level):
+    """Return object with ``compress(data)`` and ``flush()`` for encoding"""
+    if encoding == 'br':
+        return brotli.Compressor(quality=level)
+    # wbits of 16 + MAX_WBITS generates the gzip header and trailer
+    return zlib.compressobj(
+        min(level, MAX_GZIP_LEVEL), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compress_stream(chunks, encoding, level):
+    """Generator yielding compressed chunks"""
+    c = compressor(encoding, level)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = c.process(chunk) if encoding == 'br' else c.compress(chunk)
+        if data:
+            yield data
+    yield c.finish() if encoding == 'br' else c.flush()
+
+
+def compress_response(response):
+    """``after_request`` hook, compressing eligible responses
+
+    Skips responses already encoded, unsuccessful or of other content
+    types, as well as those smaller than ``COMPRESS_MIN_SIZE`` bytes.
+    Streamed responses, of unknown size, are always compressed.
+    ``COMPRESS_LEVEL`` is capped at gzip's highest level for gzip.
+    """
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    # Including those already encoded, such as HAPI bytes relayed as is
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers:
+        return response
+    encoding = accepted_encoding()
+    if not encoding:
+        return response
+
+    level = current_app.config.get("COMPRESS_LEVEL")
+    if response.is_streamed:
+        response.response = compress_stream(
+            response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get("COMPRESS_MIN_SIZE"):
+            return response
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=level))
+        else:
+            response.set_data(gzip.compress(
+                data, compresslevel=min(level, MAX_GZIP_LEVEL)))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
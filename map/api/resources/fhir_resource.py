@@ -1,9 +1,113 @@
-from flask import make_response, request
+from contextlib import closing
+
+from flask import Response, current_app, make_response, request
 from flask_restful import Resource
 from werkzeug.exceptions import BadRequest, Unauthorized
 
+from map.api.compression import accepted_encoding
 from map.authz import AuthorizedUser, UnauthorizedUser
+from map.authz.authorizedresource import authz_read_elements
+from map.authz.authorizeduser import resource_written
 from map.fhir import HapiRequest, ResourceType
+from map.fhir.hapi import STREAM_CHUNK_SIZE
+from map.fhir.projection import project_bundle
+from map.timing import timed_phase
+
+# Search parameters that may add resources of other types to results
+INCLUDE_PARAMS = ('_include', '_revinclude', '_contained')
+
+
+def json_response(*args):
+    """make_response() for a JSON body, timed as the request's json phase"""
+    with timed_phase('json'):
+        return make_response(*args)
+
+
+def passthrough_allowed(authz, resource_type, search_dict=None):
+    """True if HAPI's response may be relayed without per resource checks
+
+    Requires configured ``PASSTHROUGH_READS``, a user who may read every
+    resource of the type, and no search parameter that could include
+    resources of another type, with or without a modifier such as
+    ``_include:iterate``.
+    """
+    if not current_app.config.get("PASSTHROUGH_READS"):
+        return False
+    if search_dict and any(
+            k.split(':')[0] in INCLUDE_PARAMS for k in search_dict):
+        return False
+    return authz.can_read_all(resource_type)
+
+
+def checkable_projection(search_dict):
+    """Adjust client requested projection, to keep authz checks reliable
+
+    Elements the authorization checks depend on are added to any client
+    ``_elements``, and a ``_summary`` which might drop them is ignored,
+    as servers may.
+
+    :returns: (search parameters for HAPI, client requested elements or
+      None), the latter to be stripped down to after checks.
+    """
+    params = search_dict.copy()
+    if params.get('_summary') not in (None, 'count', 'false'):
+        params.pop('_summary')
+    if '_elements' not in params:
+        return params, None
+
+    elements = set(
+        e for e in params['_elements'].split(',') if e and '.' not in e)
+    params['_elements'] = ','.join(
+        sorted(elements.union(authz_read_elements())))
+    return params, elements
+
+
+def scoped_search(authz, resource_type, search_dict):
+    """Add the user's ``search_scope`` to search_dict, for HAPI to apply
+
+    A scope parameter also given by the client is repeated, so both
+    apply (FHIR combines repeated parameters with AND).
+    """
+    scope = authz.search_scope(resource_type)
+    if not scope:
+        return search_dict
+    if hasattr(search_dict, 'lists'):
+        params = {k: v if len(v) > 1 else v[0] for k, v in search_dict.lists()}
+    else:
+        params = dict(search_dict)
+    for k, v in scope.items():
+        if k not in params:
+            params[k] = v
+            continue
+        given = params[k] if isinstance(params[k], list) else [params[k]]
+        params[k] = given + [v]
+    return params
+
+
+def passthrough(hapi_res):
+    """Relay streamed HAPI response bytes, with no JSON decode or encode
+
+    If HAPI's response is compressed in an encoding the client accepts,
+    the compressed bytes are relayed as is.
+    """
+    encoding = hapi_res.headers.get('Content-Encoding')
+    headers = {}
+    if encoding and accepted_encoding(supported=(encoding,)):
+        chunks = hapi_res.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+        headers['Content-Encoding'] = encoding
+    else:
+        chunks = hapi_res.iter_content(STREAM_CHUNK_SIZE)
+
+    def body():
+        with closing(hapi_res):
+            for chunk in chunks:
+                yield chunk
+
+    response = Response(
+        body(), status=hapi_res.status_code, headers=headers,
+        content_type=hapi_res.headers.get('Content-Type'))
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 class FhirSearch(Resource):
@@ -21,9 +125,16 @@ class FhirSearch(Resource):
         except Unauthorized:
             authz = UnauthorizedUser()
 
-        bundle, status = HapiRequest.find_bundle(resource_type, request.args)
+        if passthrough_allowed(authz, resource_type, request.args):
+            return passthrough(HapiRequest.stream(resource_type, request.args))
+
+        search, elements = checkable_projection(request.args)
+        search = scoped_search(authz, resource_type, search)
+        bundle, status = HapiRequest.find_bundle(resource_type, search)
         bundle = authz.check('read', bundle)
-        return make_response(bundle, status)
+        if elements is not None:
+            project_bundle(bundle, elements, unless_subsetted=False)
+        return json_response(bundle, status)
 
     def post(self, resource_type):
         try:
@@ -39,7 +150,9 @@ class FhirSearch(Resource):
                 "required FHIR resource not found;"
                 " 'Content-Type' header ill defined.")
         resource = au.check('write', request.json)
-        return make_response(HapiRequest.post_resource(resource))
+        result = HapiRequest.post_resource(resource)
+        resource_written(resource)
+        return json_response(result)
 
 
 class FhirResource(Resource):
@@ -59,9 +172,13 @@ class FhirResource(Resource):
         except Unauthorized:
             authz = UnauthorizedUser()
 
+        if passthrough_allowed(authz, resource_type):
+            return passthrough(
+                HapiRequest.stream(f"{resource_type}/{resource_id}"))
+
         resource, status = HapiRequest.find_by_id(resource_type, resource_id)
         resource = authz.check('read', resource)
-        return make_response(resource, status)
+        return json_response(resource, status)
 
     def put(self, resource_type, resource_id):
         try:
@@ -81,4 +198,6 @@ class FhirResource(Resource):
         au = AuthorizedUser.from_auth_header(
             request.headers.get('Authorization'))
         resource = au.check('write', request.json)
-        return make_response(HapiRequest.put_resource(resource))
+        result = HapiRequest.put_resource(resource)
+        resource_written(resource)
+        return json_response(result)
@@ -1,15 +1,22 @@
 from flask import Blueprint
 from flask_restful import Api
 
+from map.api.compression import compress_response
 from map.api.resources import (
     FhirResource,
     FhirSearch,
 )
 from map.config import API_PREFIX
+from map.fhir.hapi import start_deadline
+from map.timing import add_server_timing, start_timing
 
 
 blueprint = Blueprint('api', __name__, url_prefix=API_PREFIX)
 api = Api(blueprint)
+blueprint.before_request(start_deadline)
+blueprint.before_request(start_timing)
+blueprint.after_request(compress_response)
+blueprint.after_request(add_server_timing)
 
 
 api.add_resource(FhirResource, '/<string:resource_type>/<int:resource_id>')
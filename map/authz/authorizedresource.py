@@ -2,12 +2,44 @@ from flask import current_app
 from werkzeug.exceptions import Unauthorized
 
 
+def same_org_check():
+    """Returns configured ``SAME_ORG_CHECK``, limiting org roles' reads"""
+    return current_app.config['SAME_ORG_CHECK'] == True  # noqa: E712
+
+
 class AuthzCheckResource(object):
     """Base class for FHIR Resource authorization check"""
+
+    # Top level elements ``read`` and ``unauth_read`` depend on
+    read_elements = ()
+
     def __init__(self, authz_user, fhir_resource):
         self.user = authz_user
         self.resource = fhir_resource
 
+    @classmethod
+    def read_all(cls, authz_user):
+        """True if ``read`` permits every resource of the type to user
+
+        Used to skip per resource checks, when the outcome is known
+        without looking at the resource.  Override with ``read``.
+        """
+        return True
+
+    @classmethod
+    def unauth_read_all(cls):
+        """True if ``unauth_read`` permits every resource of the type"""
+        return False
+
+    @classmethod
+    def search_scope(cls, authz_user):
+        """Search parameters limiting results to what ``read`` may permit
+
+        Added to the user's searches, so HAPI filters rather than the
+        post-filter in ``check``; must never be narrower than ``read``.
+        """
+        return {}
+
     def read(self):
         """Default case, FHIR objects all readable"""
         return self.resource
@@ -26,6 +58,11 @@ class AuthzCheckCarePlan(AuthzCheckResource):
         super().__init__(authz_user, fhir_resource)
 
     owned = True
+    read_elements = ('subject',)
+
+    @classmethod
+    def read_all(cls, authz_user):
+        return cls.owned
 
     def read(self):
         """Only owning patient may read"""
@@ -59,6 +96,8 @@ class AuthzCheckCommunication(AuthzCheckResource):
     def __init__(self, authz_user, fhir_resource):
         super().__init__(authz_user, fhir_resource)
 
+    read_elements = ('category',)
+
     def unauth_read(self):
         """Communication with matching identifier available for reads
 
@@ -85,6 +124,10 @@ class AuthzCheckDocumentReference(AuthzCheckResource):
     def __init__(self, authz_user, fhir_resource):
         super().__init__(authz_user, fhir_resource)
 
+    @classmethod
+    def unauth_read_all(cls):
+        return True
+
     def unauth_read(self):
         """DocumentReferences wide open for reads"""
         return self.resource
@@ -94,6 +137,8 @@ class AuthzCheckPatient(AuthzCheckResource):
     def __init__(self, authz_user, fhir_resource):
         super().__init__(authz_user, fhir_resource)
 
+    read_elements = ('identifier',)
+
     def _kc_ident_in_resource(self):
         """Keycloak Identifier found in FHIR Resource
 
@@ -119,6 +164,39 @@ class AuthzCheckPatient(AuthzCheckResource):
         """Returns true if resource refers to same user as self"""
         return self._kc_ident_in_resource()
 
+    @classmethod
+    def read_all(cls, authz_user):
+        """Admins, and org roles when not configured to check org"""
+        if 'admin' in authz_user.roles:
+            return True
+        if 'org_admin' in authz_user.roles or 'org_staff' in authz_user.roles:
+            return not same_org_check()
+        return False
+
+    @classmethod
+    def search_scope(cls, authz_user):
+        """Consenting patients for org roles, otherwise the user's own
+
+        Org roles may also read their own Patient.  FHIR search can't OR
+        that with the Consent scope, so when it lacks such a Consent no
+        scope is pushed down, leaving ``read`` to filter.
+        """
+        if cls.read_all(authz_user):
+            return {}
+        own = {'identifier': '|'.join((
+            authz_user.kc_identifier_system, authz_user.kc_identifier_value))}
+        if 'org_admin' in authz_user.roles or 'org_staff' in authz_user.roles:
+            org_id = authz_user.org_id()
+            if not org_id:
+                return own
+            patient_id = authz_user.patient_id()
+            if patient_id and (
+                    patient_id not in authz_user.consented_users(org_id)):
+                return {}
+            return {'_has:Consent:patient:organization': '/'.join((
+                'Organization', org_id))}
+        return own
+
     def read(self):
         """User's role determines read access"""
         # Admins get carte blanche
@@ -128,7 +206,7 @@ class AuthzCheckPatient(AuthzCheckResource):
         if 'org_admin' in self.user.roles or 'org_staff' in self.user.roles:
             # Org admin and staff can only view patients with consents
             # on the same organization, UNLESS configuration is set to ignore
-            if current_app.config['SAME_ORG_CHECK'] != True:
+            if not same_org_check():
                 return self.resource
 
             if (self.same_user() or
@@ -155,6 +233,10 @@ class AuthzCheckQuestionnaireResponse(AuthzCheckResource):
 
     owned = True
 
+    @classmethod
+    def read_all(cls, authz_user):
+        return cls.owned
+
     def read(self):
         """Only owning patient may read"""
         if self.owned:
@@ -170,20 +252,68 @@ class AuthzCheckQuestionnaireResponse(AuthzCheckResource):
         return self.resource
 
 
+# Check class for each resourceType; types not listed use the default
+AUTHZ_CHECK_CLASSES = {
+    'CarePlan': AuthzCheckCarePlan,
+    'Communication': AuthzCheckCommunication,
+    'Consent': AuthzCheckConsent,
+    'DocumentReference': AuthzCheckDocumentReference,
+    'Patient': AuthzCheckPatient,
+    'QuestionnaireResponse': AuthzCheckQuestionnaireResponse,
+}
+
+
+def authz_check_class(resource_type):
+    """Returns appropriate check class for the given resourceType"""
+    return AUTHZ_CHECK_CLASSES.get(resource_type, AuthzCheckResource)
+
+
+def authz_read_elements():
+    """Returns all elements any resource type's read check depends on"""
+    elements = set(AuthzCheckResource.read_elements)
+    for check_class in AUTHZ_CHECK_CLASSES.values():
+        elements.update(check_class.read_elements)
+    return elements
+
+
 def authz_check_resource(authz_user, resource):
     """Factory returns appropriate instance for authorization check"""
-    t = resource['resourceType']
-    if t == 'CarePlan':
-        return AuthzCheckCarePlan(authz_user, resource)
-    elif t == 'Communication':
-        return AuthzCheckCommunication(authz_user, resource)
-    elif t == 'Consent':
-        return AuthzCheckConsent(authz_user, resource)
-    elif t == 'DocumentReference':
-        return AuthzCheckDocumentReference(authz_user, resource)
-    elif t == 'QuestionnaireResponse':
-        return AuthzCheckQuestionnaireResponse(authz_user, resource)
-    elif t == 'Patient':
-        return AuthzCheckPatient(authz_user, resource)
-    else:
-        return AuthzCheckResource(authz_user, resource)
+    check_class = authz_check_class(resource['resourceType'])
+    return check_class(authz_user, resource)
+
+
+def authz_filter(authz_user, method):
+    """Returns predicate, True for each resource authz_user may ``method``
+
+    For checking many resources, such as a Bundle's entries.  The check
+    class for each resourceType is resolved, and if need be instantiated,
+    once; the instance is then pointed at each resource in turn.  Types
+    for which the outcome is known up front (see ``read_all``) skip the
+    per resource check.
+
+    :param method: check method name, i.e. 'read' or 'write'
+    """
+    checkers = {}
+
+    def allowed(resource):
+        resource_type = resource['resourceType']
+        try:
+            checker = checkers[resource_type]
+        except KeyError:
+            check_class = authz_check_class(resource_type)
+            if method == 'read' and check_class.read_all(authz_user):
+                checker = None
+            else:
+                checker = check_class(authz_user, None)
+            checkers[resource_type] = checker
+
+        if checker is None:
+            return True
+        checker.resource = resource
+        try:
+            getattr(checker, method)()
+        except Unauthorized:
+            return False
+        return True
+
+    return allowed
@@ -1,39 +1,106 @@
 """Authorization"""
+from hashlib import sha256
+import time
+
 from flask import current_app
-import json
-from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTClaimsError
 from werkzeug.exceptions import Unauthorized
 
+from map.commons.cache import TTLCache
 from map.fhir import Bundle, HapiRequest
-from map.authz.authorizedresource import authz_check_resource
+from map.timing import timed_phase
+from map.authz.consent_index import ACTIVE, consent_index
+from map.authz.jwks import key_registry
+from map.authz.authorizedresource import (
+    authz_check_class,
+    authz_check_resource,
+    authz_filter,
+)
 
 
 def validate_jwt(bearer_token):
     """Validate bearer token signature against Authorization server public key
     """
-    # todo: decode JSON string in config
-    keys = current_app.config['AUTHZ_JWKS_JSON']
-    try:
-        json_web_keys = json.loads(keys)
-    except json.decoder.JSONDecodeError:
-        json_web_keys = keys
-
-    json_payload = jwt.decode(
-        token=bearer_token,
-        key=json_web_keys,
+    return key_registry().decode(
+        bearer_token,
         # todo: fix JWTClaimsError
         options={'verify_aud': False},
     )
-    return json_payload
+
+
+def token_cache():
+    """Returns the app's cache of verified token payloads"""
+    cache = current_app.extensions.get('token_cache')
+    if cache is None:
+        cache = current_app.extensions['token_cache'] = TTLCache(
+            max_size=current_app.config.get("AUTHZ_TOKEN_CACHE_SIZE"),
+            ttl=current_app.config.get("AUTHZ_TOKEN_CACHE_TTL"))
+    return cache
+
+
+def consent_roster_cache():
+    """Returns the app's cache of consented patient ids, keyed by org id"""
+    cache = current_app.extensions.get('consent_roster_cache')
+    if cache is None:
+        cache = current_app.extensions['consent_roster_cache'] = TTLCache(
+            max_size=current_app.config.get("CONSENT_ROSTER_CACHE_SIZE"),
+            ttl=current_app.config.get("CONSENT_ROSTER_CACHE_TTL"))
+    return cache
+
+
+def identity_cache():
+    """Returns the app's cache of (patient_id, org_id), keyed by (iss, sub)"""
+    cache = current_app.extensions.get('identity_cache')
+    if cache is None:
+        cache = current_app.extensions['identity_cache'] = TTLCache(
+            max_size=current_app.config.get("IDENTITY_CACHE_SIZE"),
+            ttl=current_app.config.get("IDENTITY_CACHE_TTL"))
+    return cache
+
+
+def resource_written(resource):
+    """Drop cached authorization state made stale by writing resource
+
+    A Consent may move between organizations on update, so all cached
+    rosters are dropped rather than just those the new version names,
+    and the Consent index is woken to refresh from its own thread; the
+    write has succeeded, so a failing refresh mustn't fail the response.
+    A Patient drops the identity mapping of each identifier it carries.
+    """
+    if resource.get('resourceType') == 'Consent':
+        consent_roster_cache().clear()
+        index = consent_index()
+        if index is not None:
+            index.wake()
+    elif resource.get('resourceType') == 'Patient':
+        cache = identity_cache()
+        for identifier in resource.get('identifier', []):
+            cache.pop((identifier.get('system'), identifier.get('value')))
 
 
 def jwt_payload(bearer_token):
+    """Returns verified payload of bearer token
+
+    Verified payloads are cached by digest of the token, until the
+    token's ``exp`` (or the configured max TTL, if sooner)
+    """
+    cache = token_cache()
+    digest = sha256(bearer_token.encode('utf-8')).hexdigest()
+    payload = cache.get(digest)
+    if payload is not None:
+        return dict(payload)
+
     try:
-        payload = validate_jwt(bearer_token)
+        with timed_phase('auth'):
+            payload = validate_jwt(bearer_token)
     except (ExpiredSignatureError, JWTClaimsError) as e:
         raise Unauthorized(str(e))
 
+    if 'exp' in payload:
+        ttl = min(float(payload['exp']) - time.time(), cache.ttl)
+        if ttl > 0:
+            cache.set(digest, dict(payload), ttl=ttl)
+
     # current_app.logger.debug('JWT payload: %s', payload)
     return payload
 
@@ -41,6 +108,14 @@ def jwt_payload(bearer_token):
 class UnauthorizedUser(object):
     """Back door for unauthorized resource access"""
 
+    def can_read_all(self, resource_type):
+        """True if every resource of resource_type is readable, unchecked"""
+        return authz_check_class(resource_type).unauth_read_all()
+
+    def search_scope(self, resource_type):
+        """Search parameters limiting results to readable resources"""
+        return {}
+
     def check(self, verb, fhir):
         """Raises Unauthorized unless user has authority to verb the contents
 
@@ -92,6 +167,16 @@ class AuthorizedUser(object):
         bearer_token = auth_header.split()[-1]
         return cls(jwt_payload(bearer_token))
 
+    def can_read_all(self, resource_type):
+        """True if every resource of resource_type is readable, unchecked"""
+        return authz_check_class(resource_type).read_all(self)
+
+    def search_scope(self, resource_type):
+        """Search parameters limiting results to readable resources"""
+        if not current_app.config.get("AUTHZ_PUSHDOWN"):
+            return {}
+        return authz_check_class(resource_type).search_scope(self)
+
     def check(self, verb, fhir):
         """Raises Unauthorized unless user has authority to verb the contents
 
@@ -105,18 +190,9 @@ class AuthorizedUser(object):
             raise ValueError(f'{verb} not in ("read", "write")')
 
         if fhir['resourceType'] == 'Bundle':
+            # For bundled/search results, filter out unauthorized
             bundle = Bundle(fhir)
-            remove_ids = []
-            for item in bundle.resources():
-                ar = authz_check_resource(authz_user=self, resource=item)
-                try:
-                    getattr(ar, verb)()
-                except Unauthorized:
-                    # For bundled/search results, filter out unauthorized
-                    remove_ids.append(item['id'])
-
-            if remove_ids:
-                bundle.remove_entries(remove_ids)
+            bundle.filter_entries(authz_filter(self, verb))
             return bundle.bundle
         else:
             ar = authz_check_resource(authz_user=self, resource=fhir)
@@ -127,7 +203,13 @@ class AuthorizedUser(object):
         return resource['id'] in self.consented_users(org_id=self.org_id())
 
     def consented_users(self, org_id):
-        """Lookup all users with consent on given org"""
+        """Lookup all users with consent on given org
+
+        Answered by the local ``consent_index`` when configured and loaded.
+        Otherwise rosters are shared across requests (see
+        ``consent_roster_cache``) and dropped whenever a Consent is written
+        through the API.  Either way, only ``active`` Consents count.
+        """
         if not org_id:
             return set()
 
@@ -135,43 +217,72 @@ class AuthorizedUser(object):
         if hasattr(self, '_consented_users'):
             return self._consented_users
 
-        self._consented_users = set()
-        result, status = HapiRequest.find_bundle('Consent', search_dict={
-            'organization': '/'.join(("Organization", str(org_id))),
-            '_include': "Consent.patient",
-            '_count': 1000})
-        bundle = Bundle(result)
-        for i in bundle.resources():
-            if (i['resourceType'] == 'Consent' and
-                    i['provision']['type'] == 'permit'):
-                self._consented_users.add(
-                    i['patient']['reference'].split('/')[1])
+        index = consent_index()
+        if index is not None:
+            self._consented_users = index.patients(org_id)
+            return self._consented_users
+
+        cache = consent_roster_cache()
+        roster = cache.get(str(org_id))
+        if roster is None:
+            roster = frozenset(
+                i['patient']['reference'].split('/')[1]
+                for i in HapiRequest.stream_resources(
+                    'Consent',
+                    search_dict={
+                        'organization': '/'.join(
+                            ("Organization", str(org_id))),
+                        'status': ACTIVE},
+                    elements=('provision', 'patient'))
+                if (i['resourceType'] == 'Consent' and
+                    i['provision']['type'] == 'permit'))
+            cache.set(str(org_id), roster)
+
+        self._consented_users = set(roster)
         # current_app.logger.debug("consented users: %s" % self._consented_users)
         return self._consented_users
 
     def extract_internals(self, resource=None):
-        """Round trip or extract identifiers for self"""
+        """Round trip or extract identifiers for self
+
+        Lookups are cached across requests by (iss, sub); misses are
+        cached too, for the shorter IDENTITY_NEGATIVE_TTL, as a Patient
+        may yet be created for the user.
+        """
         # Skip out if already done.
         if hasattr(self, "_patient_id") and self._patient_id is not None:
             return
 
+        status, cache = 200, None
+        key = (self.kc_identifier_system, self.kc_identifier_value)
         if not resource:
+            cache = identity_cache()
+            cached = cache.get(key)
+            if cached is not None:
+                self._patient_id, self._org_id = cached
+                return
+
             resource, status = HapiRequest.find_one('Patient', search_dict={
-                'identifier': '|'.join((
-                    self.kc_identifier_system, self.kc_identifier_value))})
+                'identifier': '|'.join(key)},
+                elements=('managingOrganization',))
 
         if status == 400:
             # Patient not found, leave
             self._patient_id, self._org_id = None, None
+            if cache is not None:
+                cache.set(key, (None, None), ttl=current_app.config.get(
+                    "IDENTITY_NEGATIVE_TTL"))
             return
 
         if resource['resourceType'] != 'Patient':
             raise ValueError(
-                "Unexpected resourceType {resource['resourceType]}")
+                f"Unexpected resourceType {resource['resourceType']}")
 
         self._patient_id = resource['id']
         self._org_id = resource.get('managingOrganization', {}).get(
             'reference', 'Organization/').split('/')[1]
+        if cache is not None:
+            cache.set(key, (self._patient_id, self._org_id))
 
     def org_id(self):
         """Return managingOrganization identifier, if available"""
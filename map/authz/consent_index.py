@@ -0,0 +1,298 @@
+"""Local index of Consents, for org scoped authorization lookups
+
+Consents are reduced to rows of ``(patient, organization, provision
+type, provision class, period)`` in an embedded SQLite file, named by
+``CONSENT_INDEX_PATH``.  The first refresh bulk loads every Consent, from
+a background thread; later refreshes, polled every ``CONSENT_INDEX_POLL``
+seconds, request only Consents updated, or deleted, since the watermark.
+Only ``active`` Consents are indexed, as with HAPI roster lookups.
+"""
+import random
+import sqlite3
+from threading import Event, Lock, Thread, local
+
+from flask import current_app
+
+from map.fhir import HapiRequest
+
+# Fraction of the poll interval randomly added or subtracted, so
+# workers don't all poll HAPI at once
+POLL_JITTER = 0.1
+# Consent elements the index is built from
+INDEXED_ELEMENTS = ('status', 'patient', 'organization', 'provision')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS consent (
+    consent_id TEXT NOT NULL,
+    organization TEXT NOT NULL,
+    patient TEXT NOT NULL,
+    provision_type TEXT,
+    period_start TEXT,
+    period_end TEXT,
+    PRIMARY KEY (consent_id, organization));
+CREATE INDEX IF NOT EXISTS consent_by_org
+    ON consent (organization, provision_type);
+CREATE TABLE IF NOT EXISTS consent_class (
+    consent_id TEXT NOT NULL,
+    system TEXT,
+    code TEXT);
+CREATE INDEX IF NOT EXISTS consent_class_by_id ON consent_class (consent_id);
+CREATE TABLE IF NOT EXISTS watermark (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_updated TEXT);
+"""
+# Only Consents of this status grant access
+ACTIVE = 'active'
+
+
+def later(*instants):
+    """Returns the latest of the given ISO 8601 instants, ignoring None"""
+    return max(filter(None, instants), default=None)
+
+
+def reference_id(reference):
+    """Returns id from a relative reference, such as ``Patient/12``"""
+    return reference.get('reference', '').split('/')[-1] or None
+
+
+class ConsentIndex(object):
+    """Consent rows by organization, in a local SQLite file
+
+    Each thread uses its own connection; writes are serialised.  Until
+    ``loaded`` is set, by a complete refresh in this or a prior process,
+    the index is partial and mustn't be consulted.
+    """
+
+    def __init__(self, path, poll_interval=60):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = local()
+        self._lock = Lock()
+        self._stop = Event()
+        self._wake = Event()
+        self.loaded = Event()
+        self.connection.executescript(SCHEMA)
+        if self.connection.execute(
+                "SELECT 1 FROM watermark").fetchone() is not None:
+            self.loaded.set()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            path=config.get('CONSENT_INDEX_PATH'),
+            poll_interval=config.get('CONSENT_INDEX_POLL'))
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = self._local.connection = sqlite3.connect(self.path)
+        return conn
+
+    @property
+    def watermark(self):
+        """``meta.lastUpdated`` of the latest Consent indexed, or None"""
+        row = self.connection.execute(
+            "SELECT last_updated FROM watermark").fetchone()
+        return row[0] if row else None
+
+    def patients(
+            self, org_id, provision_type='permit', provision_class=None,
+            at=None):
+        """Returns set of patient ids with a Consent on org_id
+
+        :param provision_class: optional ``(system, code)`` the Consent
+          must include
+        :param at: optional ISO 8601 instant within the provision period
+        """
+        query = [
+            "SELECT DISTINCT patient FROM consent c"
+            " WHERE organization = ? AND provision_type = ?"]
+        args = [str(org_id), provision_type]
+        if provision_class:
+            query.append(
+                "AND EXISTS (SELECT 1 FROM consent_class k WHERE"
+                " k.consent_id = c.consent_id AND k.system = ?"
+                " AND k.code = ?)")
+            args.extend(provision_class)
+        if at:
+            query.append(
+                "AND (period_start IS NULL OR period_start <= ?)"
+                " AND (period_end IS NULL OR period_end >= ?)")
+            args.extend((at, at))
+        rows = self.connection.execute(' '.join(query), args)
+        return set(row[0] for row in rows)
+
+    def upsert(self, consents):
+        """Replace index rows for each of the given Consent resources
+
+        Only ``active`` Consents naming a patient and an organization
+        keep rows.  The watermark is left for ``refresh`` to advance.
+
+        :returns: greatest ``meta.lastUpdated`` of the Consents, or None
+        """
+        latest = None
+        conn = self.connection
+        with self._lock, conn:
+            for consent in consents:
+                self._remove(conn, consent['id'])
+                last_updated = consent.get('meta', {}).get('lastUpdated')
+                if last_updated and (latest is None or last_updated > latest):
+                    latest = last_updated
+                if consent.get('status') != ACTIVE:
+                    continue
+
+                provision = consent.get('provision', {})
+                period = provision.get('period', {})
+                patient = reference_id(consent.get('patient', {}))
+                org_ids = [
+                    org_id for org_id in (
+                        reference_id(org)
+                        for org in consent.get('organization', []))
+                    if org_id]
+                if not (patient and org_ids):
+                    continue
+                conn.executemany(
+                    "INSERT INTO consent VALUES (?, ?, ?, ?, ?, ?)",
+                    [(consent['id'], org_id, patient,
+                      provision.get('type'), period.get('start'),
+                      period.get('end'))
+                     for org_id in org_ids])
+                conn.executemany(
+                    "INSERT INTO consent_class VALUES (?, ?, ?)",
+                    [(consent['id'], c.get('system'), c.get('code'))
+                     for c in provision.get('class', [])])
+        return latest
+
+    def discard(self, *consent_ids):
+        """Remove rows for the given Consent ids"""
+        conn = self.connection
+        with self._lock, conn:
+            for consent_id in consent_ids:
+                self._remove(conn, consent_id)
+
+    @staticmethod
+    def _remove(conn, consent_id):
+        conn.execute("DELETE FROM consent WHERE consent_id = ?", (consent_id,))
+        conn.execute(
+            "DELETE FROM consent_class WHERE consent_id = ?", (consent_id,))
+
+    def refresh(self):
+        """Index Consents changed since the watermark; all if none yet
+
+        Consents are requested in ``_lastUpdated`` order, and those deleted
+        since the watermark dropped.  The watermark only advances once all
+        are indexed, so an interrupted refresh is repeated by the next.
+
+        :returns: number of Consents indexed
+        """
+        watermark = self.watermark
+        search = {'_sort': '_lastUpdated'}
+        if watermark:
+            # ``ge`` as others may share the watermark's instant; re-indexing
+            # those already seen is harmless
+            search['_lastUpdated'] = f"ge{watermark}"
+        count = 0
+        latest = watermark
+        batch = []
+        for consent in HapiRequest.iter_resources(
+                'Consent', search, elements=INDEXED_ELEMENTS):
+            if consent['resourceType'] != 'Consent':
+                continue
+            batch.append(consent)
+            if len(batch) >= current_app.config.get("HAPI_PAGE_SIZE"):
+                count += len(batch)
+                latest = later(latest, self.upsert(batch))
+                batch = []
+        count += len(batch)
+        latest = later(latest, self.upsert(batch))
+        if watermark:
+            self.discard(*self.deleted_since(watermark))
+
+        conn = self.connection
+        with self._lock, conn:
+            current = conn.execute(
+                "SELECT last_updated FROM watermark").fetchone()
+            if current is None or (latest and (
+                    current[0] is None or latest > current[0])):
+                conn.execute(
+                    "INSERT OR REPLACE INTO watermark VALUES (1, ?)",
+                    (latest,))
+        self.loaded.set()
+        return count
+
+    @staticmethod
+    def deleted_since(since):
+        """Returns ids of Consents deleted from HAPI since given instant
+
+        Per ``Consent/_history``, newest first; a Consent deleted then
+        created again isn't included.
+        """
+        seen, deleted = set(), set()
+        for bundle in HapiRequest.iter_pages(
+                'Consent/_history', {'_since': since}):
+            for entry in bundle.get('entry', []):
+                consent_id = entry['request']['url'].split('/')[1]
+                if consent_id in seen:
+                    continue
+                seen.add(consent_id)
+                if entry['request']['method'] == 'DELETE':
+                    deleted.add(consent_id)
+        return deleted
+
+    def rebuild(self):
+        """Drop all rows and bulk load every Consent"""
+        self.loaded.clear()
+        conn = self.connection
+        with self._lock, conn:
+            for table in ('consent', 'consent_class', 'watermark'):
+                conn.execute(f"DELETE FROM {table}")
+        return self.refresh()
+
+    def start(self, app):
+        """Load, then poll for changed Consents, from a daemon thread"""
+        Thread(target=self._poll_loop, args=(app,), daemon=True).start()
+
+    def wake(self):
+        """Have the polling thread refresh now, rather than at its next poll
+
+        Returns at once; the refresh, and any failure of it, belongs to the
+        polling thread.
+        """
+        self._wake.set()
+
+    def _poll_loop(self, app):
+        delay = 0
+        while True:
+            self._wake.wait(delay)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            with app.app_context():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    app.logger.error(f"Consent index refresh failed: {e}")
+            jitter = random.uniform(-POLL_JITTER, POLL_JITTER)
+            delay = self.poll_interval * (1 + jitter)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def consent_index():
+    """Returns the app's loaded ``ConsentIndex``, or None
+
+    None if not configured, or not yet loaded.  Built and set loading, then
+    polling, from a background thread on first use, so requests needn't
+    wait on the bulk load.
+    """
+    if not current_app.config.get('CONSENT_INDEX_PATH'):
+        return None
+    index = current_app.extensions.get('consent_index')
+    if index is None:
+        index = ConsentIndex.from_config(current_app.config)
+        index.start(current_app._get_current_object())
+        current_app.extensions['consent_index'] = index
+    return index if index.loaded.is_set() else None
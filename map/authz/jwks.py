@@ -0,0 +1,150 @@
+"""Registry of parsed JSON Web Keys, for bearer token validation
+
+Keys configured via ``AUTHZ_JWKS_JSON`` (and optionally refreshed from
+``AUTHZ_JWKS_URL``) are parsed once per worker into key objects, indexed
+by ``kid`` and algorithm.  Validating a token then takes a dictionary
+lookup and a single signature check.
+"""
+import json
+import random
+from threading import Event, Lock, Thread
+import time
+
+from flask import current_app
+from jose import jwk, jwt
+from jose.exceptions import JWTError
+import requests
+
+# Fraction of the refresh interval randomly added or subtracted, so
+# workers don't all hit the JWKS endpoint at once
+REFRESH_JITTER = 0.1
+# Minimum seconds between refreshes triggered by an unknown kid
+MIN_REFRESH_INTERVAL = 30
+
+
+def parse_jwks(jwks):
+    """Returns ``{(kid, alg): key}`` for keys in the given JWKS
+
+    :param jwks: JWK Set (dict with ``keys``) or a single JWK, as dict or
+      JSON string.  Keys lacking ``alg`` are indexed under alg None.
+
+    """
+    if isinstance(jwks, str):
+        jwks = json.loads(jwks)
+    keys = jwks['keys'] if 'keys' in jwks else [jwks]
+    index = {}
+    for key in keys:
+        if key.get('use', 'sig') != 'sig':
+            continue
+        alg = key.get('alg')
+        index[(key.get('kid'), alg)] = jwk.construct(
+            key, algorithm=alg or default_algorithm(key))
+    return index
+
+
+def default_algorithm(key):
+    return {'RSA': 'RS256', 'EC': 'ES256', 'oct': 'HS256'}.get(key['kty'])
+
+
+class KeyRegistry(object):
+    """Parsed keys, with optional background refresh from a JWKS url
+
+    Configuration which isn't a JWKS, such as a plain shared secret, is
+    passed through to ``jose`` untouched, as before.
+    """
+
+    def __init__(self, jwks=None, url=None, refresh_interval=3600):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.keys = {}
+        self.raw_key = None
+        self.last_refresh = 0
+        self._lock = Lock()
+        self._stop = Event()
+
+        if jwks:
+            try:
+                self.keys = parse_jwks(jwks)
+            except (ValueError, KeyError, TypeError, JWTError):
+                self.raw_key = jwks
+        if url:
+            self.refresh()
+            Thread(
+                target=self._refresh_loop,
+                args=(current_app._get_current_object(),),
+                daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            jwks=config.get('AUTHZ_JWKS_JSON'),
+            url=config.get('AUTHZ_JWKS_URL'),
+            refresh_interval=config.get('AUTHZ_JWKS_REFRESH'))
+
+    def refresh(self):
+        """Fetch keys from url; keep last known good keys on any failure"""
+        with self._lock:
+            self.last_refresh = time.monotonic()
+            try:
+                response = requests.get(self.url, timeout=10)
+                response.raise_for_status()
+                keys = parse_jwks(response.json())
+            except (requests.RequestException, ValueError, KeyError,
+                    JWTError) as e:
+                current_app.logger.error(f"JWKS refresh failed: {e}")
+                return False
+            if keys:
+                self.keys = keys
+            return True
+
+    def _refresh_loop(self, app):
+        while True:
+            jitter = random.uniform(-REFRESH_JITTER, REFRESH_JITTER)
+            if self._stop.wait(self.refresh_interval * (1 + jitter)):
+                return
+            with app.app_context():
+                self.refresh()
+
+    def stop(self):
+        self._stop.set()
+
+    def find_key(self, kid, alg):
+        """Returns key matching kid and alg, or None"""
+        keys = self.keys
+        key = keys.get((kid, alg)) or keys.get((kid, None))
+        if key is None and kid is None:
+            # No kid in token, use the only key of its algorithm
+            candidates = [k for (_, a), k in keys.items() if a in (alg, None)]
+            if len(candidates) == 1:
+                key = candidates[0]
+        return key
+
+    def decode(self, token, options=None):
+        """Verify token signature and claims; return payload
+
+        :raises JWTError: on an unknown key or failed verification
+        """
+        if self.raw_key is not None:
+            return jwt.decode(token=token, key=self.raw_key, options=options)
+
+        header = jwt.get_unverified_header(token)
+        kid, alg = header.get('kid'), header.get('alg')
+        key = self.find_key(kid, alg)
+        if (key is None and self.url and
+                time.monotonic() - self.last_refresh > MIN_REFRESH_INTERVAL):
+            # Perhaps a newly rotated key
+            self.refresh()
+            key = self.find_key(kid, alg)
+        if key is None:
+            raise JWTError(f"no key found for kid {kid} and alg {alg}")
+        return jwt.decode(
+            token=token, key=key, algorithms=[alg], options=options)
+
+
+def key_registry():
+    """Returns the app's ``KeyRegistry``, built on first use"""
+    registry = current_app.extensions.get('jwks_registry')
+    if registry is None:
+        registry = KeyRegistry.from_config(current_app.config)
+        current_app.extensions['jwks_registry'] = registry
+    return registry
@@ -0,0 +1,66 @@
+"""Circuit breaker, to fail fast while an upstream service is unhealthy
+"""
+from threading import Lock
+import time
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitBreaker(object):
+    """Track consecutive failures of calls to an upstream endpoint
+
+    ``closed``: calls allowed; ``failure_threshold`` consecutive failures
+    opens the circuit.
+    ``open``: calls refused until ``reset_timeout`` seconds have passed,
+    at which point the circuit is ``half-open``.
+    ``half-open``: a single trial call is allowed; success closes the
+    circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = Lock()
+
+    def allow(self):
+        """Returns True if a call may proceed; must then record outcome"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if (self.state == OPEN and
+                    self.clock() - self.opened_at >= self.reset_timeout):
+                self.state = HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_inconclusive(self):
+        """Record a call telling nothing of the upstream's health
+
+        Neither success nor failure; a half-open trial is released, for
+        another call to make.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = self.clock()
+            self._trial_in_flight = False
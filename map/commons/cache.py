@@ -0,0 +1,62 @@
+"""Bounded, in-process cache with time based expiry
+"""
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class TTLCache(object):
+    """Least recently used cache, entries expire after ``ttl`` seconds
+
+    Thread safe; shared by all requests within a worker process.  A
+    ``max_size`` of 0 disables the cache, as nothing is retained.
+    ``hits`` and ``misses`` count the outcomes of ``get``.
+    """
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return value for key if present and not expired, else default"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires_at, value = item
+            if expires_at <= self.clock():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, expiring after ``ttl`` or default seconds"""
+        if not self.max_size:
+            return
+        expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Remove key, if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
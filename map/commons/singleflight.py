@@ -0,0 +1,55 @@
+"""Coalesce identical concurrent calls into a single execution
+"""
+from copy import deepcopy
+from threading import Event, Lock
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Share one in-flight execution among concurrent callers of same key
+
+    The first caller for a key (the leader) executes the function; any
+    callers arriving with the same key before it completes wait on and
+    share its outcome, be that result or exception.  Results are deep
+    copied when shared, so callers may safely modify what they receive.
+    Works with threads, or greenlets when monkey patched.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Return ``fn(*args, **kwargs)``, shared with concurrent same key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return deepcopy(call.result)
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                shared = call.waiters > 0
+            call.done.set()
+        return deepcopy(call.result) if shared else call.result
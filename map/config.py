@@ -15,14 +15,63 @@ CODE_SYSTEM = {
     }
 }
 SAME_ORG_CHECK = os.getenv("SAME_ORG_CHECK", True)
+# Relay HAPI response bytes untouched when read access needs no checks
+PASSTHROUGH_READS = os.getenv("PASSTHROUGH_READS", "true").lower() == "true"
+# Narrow searches to what the user may read, before calling HAPI
+AUTHZ_PUSHDOWN = os.getenv("AUTHZ_PUSHDOWN", "true").lower() == "true"
 
 ENV = os.getenv("FLASK_ENV")
 HAPI_URL = os.getenv("HAPI_URL")
+# Pooled HAPI connections, per worker process
+HAPI_POOL_SIZE = int(os.getenv("HAPI_POOL_SIZE", 10))
+HAPI_MAX_RETRIES = int(os.getenv("HAPI_MAX_RETRIES", 2))
+HAPI_CONNECT_TIMEOUT = float(os.getenv("HAPI_CONNECT_TIMEOUT", 3.05))
+HAPI_READ_TIMEOUT = float(os.getenv("HAPI_READ_TIMEOUT", 30))
+# Seconds each API request may spend on HAPI calls, 0 for no limit
+REQUEST_TIME_BUDGET = float(os.getenv("REQUEST_TIME_BUDGET", 25))
+# Consecutive HAPI endpoint failures opening its circuit, seconds till retry
+HAPI_BREAKER_THRESHOLD = int(os.getenv("HAPI_BREAKER_THRESHOLD", 5))
+HAPI_BREAKER_RESET = float(os.getenv("HAPI_BREAKER_RESET", 30))
+# Resources read by id are cached (count, seconds) and revalidated by ETag
+HAPI_CACHE_SIZE = int(os.getenv("HAPI_CACHE_SIZE", 512))
+HAPI_CACHE_TTL = int(os.getenv("HAPI_CACHE_TTL", 3600))
+# Share one upstream request among identical concurrent searches
+HAPI_COALESCE = os.getenv("HAPI_COALESCE", "true").lower() == "true"
+# Search results requested per page when paging through all results
+HAPI_PAGE_SIZE = int(os.getenv("HAPI_PAGE_SIZE", 200))
+# Max operations sent in a single batch or transaction Bundle
+HAPI_BATCH_SIZE = int(os.getenv("HAPI_BATCH_SIZE", 100))
+# Bound on concurrent HAPI requests from a single async fan-out
+HAPI_MAX_CONCURRENCY = int(os.getenv("HAPI_MAX_CONCURRENCY", 8))
 AUTHZ_JWKS_JSON = os.getenv("AUTHZ_JWKS_JSON")
+# Optional JWKS endpoint, polled every AUTHZ_JWKS_REFRESH seconds
+AUTHZ_JWKS_URL = os.getenv("AUTHZ_JWKS_URL")
+AUTHZ_JWKS_REFRESH = int(os.getenv("AUTHZ_JWKS_REFRESH", 3600))
+# Verified bearer tokens cached till exp, or at most TTL seconds
+AUTHZ_TOKEN_CACHE_SIZE = int(os.getenv("AUTHZ_TOKEN_CACHE_SIZE", 1024))
+AUTHZ_TOKEN_CACHE_TTL = int(os.getenv("AUTHZ_TOKEN_CACHE_TTL", 600))
+CONSENT_ROSTER_CACHE_SIZE = int(os.getenv("CONSENT_ROSTER_CACHE_SIZE", 256))
+CONSENT_ROSTER_CACHE_TTL = int(os.getenv("CONSENT_ROSTER_CACHE_TTL", 300))
+# SQLite file indexing Consents for org lookups; unset to search HAPI
+CONSENT_INDEX_PATH = os.getenv("CONSENT_INDEX_PATH")
+CONSENT_INDEX_POLL = int(os.getenv("CONSENT_INDEX_POLL", 60))
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", 1024))
+IDENTITY_CACHE_TTL = int(os.getenv("IDENTITY_CACHE_TTL", 600))
+IDENTITY_NEGATIVE_TTL = int(os.getenv("IDENTITY_NEGATIVE_TTL", 30))
 SERVER_NAME = os.getenv("SERVER_NAME")
 DEBUG = ENV == "development"
 SECRET_KEY = os.getenv("SECRET_KEY")
 
+# API response compression; brotli quality (0-11), and gzip level (1-9)
+# capped at 9
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", 6))
+# Smallest (non streamed) response body, in bytes, worth compressing
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+
+# Return Server-Timing header from API; log per request timing summary
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+TIMING_LOG = os.getenv("TIMING_LOG", "false").lower() == "true"
+
 SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URI")
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
@@ -0,0 +1,138 @@
+"""Sync every Patient, and related resources, from HAPI to couch
+
+Patients are streamed from HAPI and synced concurrently by a pool of
+worker threads.  Progress is logged to a checkpoint file, so an
+interrupted run may be resumed, on request, without syncing the same
+patients again.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+from threading import Lock
+import time
+
+from .patient import CouchPatientDB
+from ..fhir import HapiRequest
+
+
+class Checkpoint(object):
+    """Append only log of patient ids synced, or failed, by a bulk sync
+
+    Each line holds ``ok <patient id>`` or ``failed <patient id> <error>``.
+    Only patients logged ``ok`` are skipped on resume; otherwise an
+    existing log is replaced.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = set()
+        if resume and path and os.path.exists(path):
+            with open(path) as log:
+                for line in log:
+                    status, _, patient_id = line.partition(' ')
+                    if status == 'ok':
+                        self.done.add(patient_id.strip())
+        self._lock = Lock()
+        self._log = open(path, 'a' if resume else 'w') if path else None
+
+    def record(self, patient_id, error=None):
+        if self._log is None:
+            return
+        line = f"ok {patient_id}" if error is None else (
+            f"failed {patient_id} {' '.join(str(error).split())}")
+        with self._lock:
+            self._log.write(line + '\n')
+            self._log.flush()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+
+
+class SyncStats(object):
+    """Counts and throughput of a bulk sync"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.patients = 0
+        self.documents = 0
+        self.skipped = 0
+        self.failures = []
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-6)
+        return (
+            f"{self.patients} patients ({self.patients / elapsed:.1f}/s), "
+            f"{self.documents} documents ({self.documents / elapsed:.1f}/s) "
+            f"synced in {elapsed:.1f}s; {len(self.failures)} failed, "
+            f"{self.skipped} skipped as previously synced")
+
+
+def sync_patient(app, patient_fhir, full=False):
+    """Sync given patient in its own app context; returns docs written"""
+    with app.app_context():
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync(full=full)
+        return len(patient.written)
+
+
+def sync_patients(
+        app, concurrency=4, checkpoint_path=None, resume=False, full=False,
+        progress=None, progress_interval=10):
+    """Sync every Patient in HAPI with its couch user db
+
+    Patients are requested page by page as the workers keep up; at most
+    twice ``concurrency`` patients are queued at any time.
+
+    :param app: Flask application, for the workers' app contexts
+    :param concurrency: number of patients synced at once
+    :param checkpoint_path: file to log progress to
+    :param resume: skip patients the checkpoint logs as synced, rather
+      than starting afresh
+    :param full: request a complete, rather than incremental, sync
+    :param progress: optional callable, periodically passed a summary
+    :returns: ``SyncStats``
+    """
+    stats = SyncStats()
+    checkpoint = Checkpoint(checkpoint_path, resume=resume)
+    last_report = time.monotonic()
+
+    def collect(done):
+        for future in done:
+            patient_id = pending.pop(future)
+            try:
+                stats.documents += future.result()
+            except Exception as e:
+                app.logger.exception(f"sync of Patient/{patient_id} failed")
+                stats.failures.append((patient_id, e))
+                checkpoint.record(patient_id, error=e)
+            else:
+                stats.patients += 1
+                checkpoint.record(patient_id)
+
+    pending = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for patient_fhir in HapiRequest.iter_resources('Patient', {}):
+                if patient_fhir['id'] in checkpoint.done:
+                    stats.skipped += 1
+                    continue
+                if len(pending) >= 2 * concurrency:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending[pool.submit(
+                    sync_patient, app, patient_fhir, full)] = (
+                        patient_fhir['id'])
+
+                if progress and (
+                        time.monotonic() - last_report > progress_interval):
+                    last_report = time.monotonic()
+                    progress(stats.summary())
+
+            collect(wait(pending).done)
+    finally:
+        checkpoint.close()
+    return stats
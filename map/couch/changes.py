@@ -0,0 +1,267 @@
+"""Push changes made in patients' couch user dbs back to HAPI
+
+Follows the server's ``_db_updates`` feed for user dbs with changes, then
+each such db's ``_changes`` feed from the sequence last processed.
+Changed Patients, Procedures and QuestionnaireResponses are synced in
+batches (see ``CouchPatientDB.sync_documents``), pushing those newer in
+couch to HAPI, provided they're the db's own patient's.  Sequences are
+persisted to a local state file once their changes are synced, so
+delivery is at least once across restarts.
+"""
+import json
+import os
+import time
+
+from flask import current_app
+
+from .patient import (
+    COUCHDB_IDENTIFIER_SYSTEM,
+    CouchPatientDB,
+    couch_key,
+    fhir_only,
+)
+from .server import db_updates
+from ..fhir import HapiRequest
+
+USERDB_PREFIX = 'userdb-'
+# Resource types patients modify on device, to push to HAPI
+REVERSE_SYNC_TYPES = ('Patient', 'Procedure', 'QuestionnaireResponse')
+# Upper bound, in seconds, of the delay between retries
+MAX_RETRY_DELAY = 300
+
+
+class ChangesConsumer(object):
+    """Consumer of couch change feeds, syncing changes to HAPI
+
+    :param server: ``couchdb.Server``
+    :param state_path: file persisting the feeds' sequences
+    :param batch_size: max changes requested, and synced, at once.  The
+      next batch is only requested once the last is synced
+    :param poll_timeout: seconds to wait for ``_db_updates``
+    :param retry_delay: seconds to wait after a failed round, doubled
+      with each consecutive failure
+    """
+
+    def __init__(
+            self, server, state_path, batch_size=100, poll_timeout=60,
+            retry_delay=1):
+        self.server = server
+        self.state_path = state_path
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.state = {'db_updates': 0, 'dbs': {}}
+        if os.path.exists(state_path):
+            with open(state_path) as state_file:
+                self.state.update(json.load(state_file))
+        # dbs with changes left unsynced by a failure, to retry
+        self.retry_dbs = set(self.state.get('retry_dbs', []))
+        self.consecutive_failures = 0
+        # id of each user db's Patient, once found
+        self.patient_ids = {}
+
+    def save_state(self):
+        """Atomically persist sequences and dbs to retry"""
+        self.state['retry_dbs'] = sorted(self.retry_dbs)
+        partial = f"{self.state_path}.partial"
+        with open(partial, 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(partial, self.state_path)
+
+    def start_from_now(self):
+        """Skip changes prior to now, i.e. on first run"""
+        self.state['db_updates'] = db_updates(
+            self.server, since='now')['last_seq']
+        self.save_state()
+
+    def updated_dbs(self):
+        """Returns (names of user dbs updated, feed's last sequence)
+
+        Waits up to ``poll_timeout`` for an update, if none are pending.
+        """
+        updates = db_updates(
+            self.server, since=self.state['db_updates'], feed='longpoll',
+            timeout=int(self.poll_timeout * 1000))
+        names = set(
+            update['db_name'] for update in updates['results']
+            if update['db_name'].startswith(USERDB_PREFIX) and
+            update.get('type') != 'deleted')
+        return names, updates['last_seq']
+
+    def drain(self, dbname):
+        """Sync every change in db since its stored sequence, by batch
+
+        :returns: number of documents synced
+        """
+        db = self.server[dbname]
+        count = 0
+        while True:
+            changes = db.changes(
+                since=self.state['dbs'].get(dbname, 0), include_docs=True,
+                limit=self.batch_size)
+            documents = [
+                change['doc'] for change in changes['results']
+                if not change.get('deleted') and change['id'].split('/')[0]
+                in REVERSE_SYNC_TYPES]
+            if documents:
+                count += self.push(dbname, documents)
+            self.state['dbs'][dbname] = changes['last_seq']
+            self.save_state()
+            if len(changes['results']) < self.batch_size:
+                return count
+
+    def patient_id(self, dbname):
+        """Returns id of the Patient whose user db is named, or None
+
+        Found by the couchdb identifier HAPI's Patient carries (see
+        ``CouchPatientDB.couch_id``), rather than from the db's own
+        documents, which the device may have forged.
+
+        :raises RuntimeError: if HAPI's search fails, for the batch to retry
+        """
+        if dbname not in self.patient_ids:
+            username = bytes.fromhex(
+                dbname[len(USERDB_PREFIX):]).decode('utf-8')
+            bundle, status = HapiRequest.find_bundle('Patient', {
+                'identifier':
+                    f"{COUCHDB_IDENTIFIER_SYSTEM}|{username}:{dbname}"})
+            if status != 200:
+                raise RuntimeError(
+                    f"HAPI search for {dbname}'s Patient failed: {bundle}")
+            entries = bundle.get('entry', [])
+            if len(entries) != 1:
+                return None
+            self.patient_ids[dbname] = entries[0]['resource']['id']
+        return self.patient_ids[dbname]
+
+    def push(self, dbname, documents):
+        """Sync couch documents with HAPI, where couch is newer
+
+        Only the db's own Patient, and documents whose ``subject`` is that
+        Patient, in couch and in HAPI, are synced; others are logged and
+        skipped, lest a device write to another patient's resources.
+
+        Current HAPI versions are read in one batch, and compared by
+        ``sync_documents``; thus syncs' own writes to couch, equal to the
+        HAPI version, are not pushed back.  Documents HAPI lacks are
+        created with their couch id.  Documents HAPI rejects as invalid
+        (4xx) are logged and skipped, as retrying can't change the outcome.
+
+        :returns: number of documents synced
+        :raises RuntimeError: on any other HAPI failure, for the batch to
+          retry
+        """
+        patient_id = self.patient_id(dbname)
+
+        def owned(key, document):
+            if key.startswith('Patient/'):
+                return key == f"Patient/{patient_id}"
+            return document.get('subject', {}).get('reference') == (
+                f"Patient/{patient_id}")
+
+        owned_documents = []
+        for document in documents:
+            if patient_id and owned(document['_id'], document):
+                owned_documents.append(document)
+            else:
+                current_app.logger.warning(
+                    f"not pushing {document['_id']} from {dbname}; not its"
+                    f" Patient/{patient_id}'s")
+        documents = owned_documents
+        if not documents:
+            return 0
+
+        results = HapiRequest.batch(
+            [('GET', couch_key(document)) for document in documents])
+        hapi_documents, missing = [], []
+        pushed = len(documents)
+        for document, (resource, status) in zip(documents, results):
+            if status == 200:
+                if not owned(document['_id'], resource):
+                    current_app.logger.warning(
+                        f"not pushing {document['_id']} from {dbname}; HAPI's"
+                        f" version isn't Patient/{patient_id}'s")
+                    pushed -= 1
+                    continue
+                hapi_documents.append(resource)
+            elif status in (404, 410):
+                missing.append(fhir_only(document))
+            else:
+                raise RuntimeError(
+                    f"HAPI read of {couch_key(document)} failed: {resource}")
+
+        patient = CouchPatientDB(None)
+        patient.userdbname = dbname
+        patient.sync_documents(hapi_documents)
+        failed = sorted(
+            key for key, (_, status) in patient.push_failures.items()
+            if status >= 500)
+        if failed:
+            raise RuntimeError(f"HAPI update of {', '.join(failed)} failed")
+
+        if missing:
+            results = HapiRequest.batch(
+                [('PUT', document) for document in missing])
+            for document, (resource, status) in zip(missing, results):
+                if status >= 500:
+                    raise RuntimeError(
+                        f"HAPI create of {couch_key(document)} failed: "
+                        f"{resource}")
+                if status >= 400:
+                    # Not retried; HAPI won't accept it as is
+                    current_app.logger.error(
+                        f"HAPI rejected {couch_key(document)} from "
+                        f"{dbname}: {resource}")
+        return pushed
+
+    def run_once(self):
+        """Sync changes in dbs updated since the last round
+
+        A db failing to sync keeps its sequence, and is retried in later
+        rounds; others proceed.
+
+        :returns: number of documents synced
+        """
+        dbnames, last_seq = self.updated_dbs()
+        count = 0
+        failed = False
+        for dbname in sorted(dbnames | self.retry_dbs):
+            try:
+                count += self.drain(dbname)
+            except Exception:
+                current_app.logger.exception(
+                    f"sync of changes in {dbname} failed; will retry")
+                self.retry_dbs.add(dbname)
+                failed = True
+            else:
+                self.retry_dbs.discard(dbname)
+        self.state['db_updates'] = last_seq
+        self.save_state()
+
+        self.consecutive_failures = self.consecutive_failures + 1 if (
+            failed) else 0
+        return count
+
+    def backoff(self):
+        """Seconds to wait before the next round, given recent failures"""
+        if not self.consecutive_failures:
+            return 0
+        return min(
+            self.retry_delay * 2 ** (self.consecutive_failures - 1),
+            MAX_RETRY_DELAY)
+
+    def run(self, app, rounds=None):
+        """Consume changes until interrupted, or for given rounds"""
+        while rounds is None or rounds > 0:
+            with app.app_context():
+                try:
+                    count = self.run_once()
+                except Exception:
+                    app.logger.exception("consuming couch changes failed")
+                    self.consecutive_failures += 1
+                else:
+                    if count:
+                        app.logger.info(f"synced {count} couch changes")
+            time.sleep(self.backoff())
+            if rounds is not None:
+                rounds -= 1
@@ -2,25 +2,34 @@
 
 Each patient gets their own couch db, and couch user.
 """
+import asyncio
 from couchdb.http import ResourceNotFound, ServerError
 from flask import current_app
 from binascii import hexlify
+from urllib.parse import urlencode
 from uuid import uuid4
 
 from .server import couch
 from ..fhir import (
     SYSTEM,
     VALUE,
+    AsyncHapiRequest,
     Bundle,
     CarePlan,
     HapiRequest,
+    ResourceType,
     identifier_with_system,
     update_identifier,
 )
+from ..fhir.hapi import json_body, next_link
 from ..utils import dt_or_none
 
 COUCHDB_IDENTIFIER_SYSTEM = 'couchdb-user:db'
 ALLOW_USERDB_REPLACEMENT = True
+# Couch bookkeeping fields, not part of the FHIR resource
+COUCH_FIELDS = ('_id', '_rev')
+# Local (unreplicated) document in each user db recording the last sync
+WATERMARK_ID = '_local/sync'
 
 
 def dbname_from_id(patient_fhir):
@@ -48,6 +57,92 @@ def dbname_from_username(username):
     return 'userdb-{}'.format(suffix.decode('utf-8'))
 
 
+def couch_key(document):
+    """Return couch document id for FHIR document, i.e. ``CarePlan/54``"""
+    return f"{document['resourceType']}/{document['id']}"
+
+
+def fhir_only(document):
+    """Return copy of couch document without couch bookkeeping fields"""
+    return {k: v for k, v in document.items() if k not in COUCH_FIELDS}
+
+
+def related(key, document, patient_id, careplan_ids, questionnaire_ids):
+    """True if the document with couch key belongs to the patient's user db
+
+    That is the patient's own Patient, one of the given CarePlans or
+    Questionnaires, or a Procedure or QuestionnaireResponse whose
+    ``subject`` is the patient or that's ``basedOn`` one of the CarePlans.
+    Type and id come from the key, as the document's own may be forged.
+    """
+    resource_type, _, doc_id = key.partition('/')
+    if resource_type == 'Patient':
+        return doc_id == patient_id
+    if resource_type == 'CarePlan':
+        return doc_id in careplan_ids
+    if resource_type == 'Questionnaire':
+        return doc_id in questionnaire_ids
+    if resource_type not in ('Procedure', 'QuestionnaireResponse'):
+        return False
+    if document.get('subject', {}).get('reference') == f"Patient/{patient_id}":
+        return True
+    return any(
+        ref.get('reference') in {f"CarePlan/{i}" for i in careplan_ids}
+        for ref in document.get('basedOn', []))
+
+
+def newer_source(hapi_updated, couch_updated):
+    """Return 'hapi' or 'couch', whichever has the later lastUpdated
+
+    HAPI maintains ``meta.lastUpdated`` (ISO 8601 format).  None if the
+    two are equally recent, or neither is dated.
+    """
+    hapi_time = dt_or_none(hapi_updated)
+    couch_time = dt_or_none(couch_updated)
+    if couch_time and (not hapi_time or couch_time > hapi_time):
+        return 'couch'
+    if hapi_time and (not couch_time or hapi_time > couch_time):
+        return 'hapi'
+    return None
+
+
+def latest_update(documents, since=None):
+    """Return the latest ``meta.lastUpdated`` of documents, or since"""
+    latest = since
+    for document in documents:
+        updated = document.get('meta', {}).get('lastUpdated')
+        if updated and (
+                latest is None or dt_or_none(updated) > dt_or_none(latest)):
+            latest = updated
+    return latest
+
+
+def couch_documents(db, keys):
+    """Return {key: document} of the user db's documents with given keys
+
+    A single ``_all_docs?keys=...&include_docs=true`` request, served by
+    couch's primary index rather than a scan of the db (as a Mango
+    ``_find`` on ``_id`` would be), and needing no design document, which
+    would replicate to the patient's devices along with the user db.  The
+    price is transferring each document's body, not just its ``_rev``;
+    bodies of couch newer documents are then at hand to push to HAPI.
+    Missing and deleted keys are omitted.
+    """
+    rows = db.view('_all_docs', keys=sorted(set(keys)), include_docs=True)
+    return {row.key: row.doc for row in rows if row.get('doc')}
+
+
+def search_results(bundle):
+    """Generator yielding resources of searchset bundle, and later pages"""
+    while True:
+        for entry in bundle.get('entry', []):
+            yield entry['resource']
+        url = next_link(bundle)
+        if not url:
+            return
+        bundle = json_body(HapiRequest.request('GET', url))
+
+
 class CouchPatientDB(object):
     """Build/sync user db for patient and related FHIR resources"""
 
@@ -55,6 +150,14 @@ class CouchPatientDB(object):
         """Initialize couch user db for given patient"""
         self.username, self.userdbname = None, None
         self.patient_fhir = patient_fhir
+        # ids of documents this instance wrote to couch
+        self.written = set()
+        # keys of documents whose best version is couch's, as HAPI didn't
+        # return one; their meta.lastUpdated was set by a device
+        self.couch_versions = set()
+        # (OperationOutcome, status) by key, of couch newer documents
+        # HAPI failed to update
+        self.push_failures = {}
 
     def couch_id(self):
         """Return FHIR compliant Identifier for Patient's couchdb details"""
@@ -102,12 +205,154 @@ class CouchPatientDB(object):
         # Now persist the given/modified patient document
         self.sync_document(self.patient_fhir)
 
-    def sync(self):
-        """API to invoke complete sync of patient and related resources"""
+    def sync(self, full=False):
+        """API to invoke sync of patient and related resources
+
+        Once a complete sync has recorded a watermark in the user db, only
+        resources changed since are synced (see ``sync_changes``), unless
+        ``full`` is requested.
+        """
         self.sync_patient()
-        self.sync_related_resources()
+        db = couch[self.userdbname]
+        watermark = None if full else db.get(WATERMARK_ID)
+        if watermark is None:
+            seq = db.changes(since='now')['last_seq']
+            documents = self.sync_related_resources()
+        else:
+            seq, documents = self.sync_changes(db, watermark)
+        self.save_watermark(db, watermark, seq, documents)
         return self.patient_fhir
 
+    def sync_changes(self, db, watermark):
+        """Sync only resources changed since the watermark's sync
+
+        Couch documents changed since the watermark's sequence are
+        gathered from the changes feed.  A single HAPI batch then requests
+        those documents, and searches for the patient's resources updated
+        since the watermark's ``lastUpdated``.  Resources related to new
+        CarePlans or Questionnaires are fetched in full.
+
+        Couch documents are only synced if both their couch and HAPI
+        versions are ``related`` to the patient, via the CarePlans and
+        Questionnaires the watermark records; others are logged and
+        dropped, lest a device write to another patient's resources.
+
+        :returns: (couch sequence prior to sync, list of synced documents)
+        """
+        patient_id = self.patient_fhir['id']
+        cp_ids = set(watermark['careplans'])
+        qb_ids = set(watermark['questionnaires'])
+
+        changes = db.changes(since=watermark['seq'], include_docs=True)
+        couch_keys = []
+        for change in changes['results']:
+            key = change['id']
+            if key.startswith('_'):
+                continue
+            # a deletion's HAPI version is checked below
+            if change.get('deleted') or related(
+                    key, change['doc'], patient_id, cp_ids, qb_ids):
+                couch_keys.append(key)
+            else:
+                current_app.logger.warning(
+                    f"{self.userdbname}: not syncing {key}, unrelated to"
+                    f" Patient/{patient_id}")
+
+        searches = [
+            (ResourceType.CarePlan.value, CarePlan.default_query_params),
+            (ResourceType.CarePlan.value,
+             {'subject': f"Patient/{patient_id}"})]
+        if cp_ids:
+            based_on = ','.join(f"CarePlan/{i}" for i in sorted(cp_ids))
+            searches.extend((
+                ('Procedure', {'based-on': based_on}),
+                ('QuestionnaireResponse', {'based-on': based_on})))
+        if qb_ids:
+            searches.append(
+                ('Questionnaire', {'_id': ','.join(sorted(qb_ids))}))
+
+        # ``ge`` as others may share the watermark's instant; syncing
+        # those already seen is harmless
+        since = {
+            '_lastUpdated': f"ge{watermark['last_updated']}",
+            '_count': current_app.config.get("HAPI_PAGE_SIZE")}
+        operations = [
+            ('GET', f"{resource_type}?{urlencode(dict(params, **since))}")
+            for resource_type, params in searches]
+        operations.extend(('GET', key) for key in couch_keys)
+
+        results = HapiRequest.batch(operations)
+        documents = {}
+        for result, status in results[:len(searches)]:
+            if status != 200:
+                continue
+            for resource in search_results(result):
+                documents.setdefault(couch_key(resource), resource)
+        for key, (result, status) in zip(couch_keys, results[len(searches):]):
+            if status != 200:
+                # i.e. couch documents never stored in HAPI
+                continue
+            if not related(key, result, patient_id, cp_ids, qb_ids):
+                current_app.logger.warning(
+                    f"{self.userdbname}: not syncing {key}, HAPI's version"
+                    f" unrelated to Patient/{patient_id}")
+                continue
+            documents.setdefault(key, result)
+
+        careplans = [
+            doc for doc in documents.values()
+            if doc['resourceType'] == 'CarePlan']
+        new_cp_ids = set(doc['id'] for doc in careplans) - cp_ids
+        new_qb_ids = set(
+            qb_id for doc in careplans
+            for qb_id in CarePlan.questionnaire_ids(doc)) - qb_ids
+        if new_cp_ids or new_qb_ids:
+            for doc in asyncio.run(self.fetch_related(new_cp_ids, new_qb_ids)):
+                documents.setdefault(couch_key(doc), doc)
+
+        return changes['last_seq'], self.sync_documents(
+            list(documents.values()))
+
+    def save_watermark(self, db, watermark, seq, documents):
+        """Record sync progress in the user db's watermark document
+
+        :param watermark: the existing watermark document, or None
+        :param seq: couch sequence prior to the sync.  Advanced past the
+          sync's own writes, unless others wrote to couch meanwhile
+        :param documents: the synced documents.  Only versions HAPI
+          returned advance ``last_updated``, device clocks being suspect
+        """
+        if self.written:
+            changes = db.changes(since=seq)
+            changed = set(
+                change['id'] for change in changes['results']
+                if not change['id'].startswith('_'))
+            if changed <= self.written:
+                seq = changes['last_seq']
+
+        previous = watermark or {}
+        cp_ids = set(previous.get('careplans', []))
+        qb_ids = set(previous.get('questionnaires', []))
+        for doc in documents:
+            if doc['resourceType'] == 'CarePlan':
+                cp_ids.add(doc['id'])
+            elif doc['resourceType'] == 'Questionnaire':
+                qb_ids.add(doc['id'])
+
+        updated = {
+            'last_updated': latest_update(
+                [doc for doc in [self.patient_fhir] + documents
+                 if couch_key(doc) not in self.couch_versions],
+                since=previous.get('last_updated')),
+            'seq': seq,
+            'careplans': sorted(cp_ids),
+            'questionnaires': sorted(qb_ids)}
+        if all(previous.get(k) == v for k, v in updated.items()):
+            return
+        if watermark is not None:
+            updated['_rev'] = watermark['_rev']
+        db[WATERMARK_ID] = updated
+
     def sync_document(self, document):
         """sync contents of any given document w/ couch user db
 
@@ -119,30 +364,89 @@ class CouchPatientDB(object):
         ``CarePlan/54``
 
         """
-        key = f"{document['resourceType']}/{document['id']}"
+        return self.sync_documents([document])[0]
+
+    def sync_documents(self, documents, retries=1):
+        """sync contents of given documents w/ couch user db, in bulk
+
+        As ``sync_document``, with a fixed number of round trips however
+        many documents: their couch counterparts are read by a single
+        request (see ``couch_documents``), couch bound updates are written
+        by a single ``_bulk_docs`` request, and couch newer documents are
+        pushed to HAPI in a batch.  Documents whose couch write conflicts,
+        having changed in couch meanwhile, are synced again, up to
+        ``retries`` times.  Failed HAPI updates are logged, and recorded in
+        ``push_failures``.
+
+        :returns: list of the best version of each document, in order
+        """
+        if not documents:
+            return []
+
         db = couch[self.userdbname]
-        if key not in db:
-            db[key] = document
-            return document
-
-        # HAPI maintains last_updated (ISO 8601 format); replace if newer
-        hapi_time = dt_or_none(
-            document.get('meta', {}).get('lastUpdated'))
-        couch_time = dt_or_none(db[key].get('meta', {}).get('lastUpdated'))
-        if (couch_time and not hapi_time) or (couch_time > hapi_time):
-            current_app.logger.debug(
-                f"found newer data in couch for {key}; push to HAPI")
-            document = HapiRequest.put_resource(db[key])
-
-        elif (hapi_time and not couch_time) or (hapi_time > couch_time):
-            current_app.logger.debug(
-                "found newer data in HAPI for %s; push to couch", key)
-            # Set couch id, revision to match current to avoid save conflict
-            document['_id'] = key
-            document['_rev'] = db[key].rev
-            db[key] = document
-
-        return document
+        keys = [couch_key(document) for document in documents]
+        couch_docs = couch_documents(db, keys)
+
+        best = list(documents)
+        to_couch, to_hapi = [], []
+        for i, (key, document) in enumerate(zip(keys, documents)):
+            couch_doc = couch_docs.get(key)
+            if couch_doc is None:
+                document['_id'] = key
+                to_couch.append(i)
+                continue
+
+            newer = newer_source(
+                document.get('meta', {}).get('lastUpdated'),
+                couch_doc.get('meta', {}).get('lastUpdated'))
+            if newer == 'couch':
+                current_app.logger.debug(
+                    f"found newer data in couch for {key}; push to HAPI")
+                to_hapi.append(i)
+            elif newer == 'hapi':
+                current_app.logger.debug(
+                    "found newer data in HAPI for %s; push to couch", key)
+                # Set couch id, revision to match current to avoid conflict
+                document['_id'] = key
+                document['_rev'] = couch_doc['_rev']
+                to_couch.append(i)
+
+        conflicts = []
+        if to_couch:
+            results = db.update([documents[i] for i in to_couch])
+            for i, (success, doc_id, rev_or_exc) in zip(to_couch, results):
+                if success:
+                    self.written.add(doc_id)
+                else:
+                    if not retries:
+                        raise rev_or_exc
+                    current_app.logger.warning(
+                        f"couch write of {doc_id} failed: {rev_or_exc}; retry")
+                    conflicts.append(i)
+
+        if to_hapi:
+            for i in to_hapi:
+                best[i] = couch_docs[keys[i]]
+                self.couch_versions.add(keys[i])
+            results = HapiRequest.batch(
+                [('PUT', fhir_only(best[i])) for i in to_hapi])
+            for i, (resource, status) in zip(to_hapi, results):
+                if status >= 400:
+                    current_app.logger.error(
+                        f"HAPI update of {keys[i]} failed: {resource}")
+                    self.push_failures[keys[i]] = resource, status
+                elif resource and resource.get('resourceType') == (
+                        documents[i]['resourceType']):
+                    best[i] = resource
+                    self.couch_versions.discard(keys[i])
+
+        if conflicts:
+            retried = self.sync_documents(
+                [fhir_only(documents[i]) for i in conflicts],
+                retries=retries - 1)
+            for i, document in zip(conflicts, retried):
+                best[i] = document
+        return best
 
     def sync_patient(self):
         """sync with couch
@@ -180,37 +484,57 @@ class CouchPatientDB(object):
         self.patient_fhir = self.sync_document(self.patient_fhir)
 
     def sync_related_resources(self):
-        """Pull any related resources into the couch user db for patient"""
+        """Pull any related resources into the couch user db for patient
 
-        related_resource_types = (
-            "CarePlan", "Questionnaire", "Procedure", "QuestionnaireResponse")
+        CarePlans are gathered first, as the remaining lookups depend on
+        them.  The Procedure, Questionnaire and QuestionnaireResponse
+        lookups are then issued concurrently (see ``fetch_related``).
+        Each group is synced in bulk (see ``sync_documents``).
 
+        :returns: list of the synced documents
+        """
         patient_id = self.patient_fhir['id']
 
         # CarePlan
         qb_ids = set()
         cp_ids = set()
-        for cp_doc in CarePlan.documents(patient_id=patient_id):
-            best_doc = self.sync_document(cp_doc)
+        careplans = self.sync_documents(
+            list(CarePlan.documents(patient_id=patient_id)))
+        for best_doc in careplans:
             cp_ids.add(best_doc['id'])
             for qb_id in CarePlan.questionnaire_ids(best_doc):
                 qb_ids.add(qb_id)
 
-        # Procedure
-        for cp_id in cp_ids:
-            procs = HapiRequest.find_bundle(
-                "Procedure", {'based-on': f'CarePlan/{cp_id}'})
-            for proc in Bundle(procs).resources():
-                self.sync_document(proc)
-
-        # Questionnaire
-        for qb_id in qb_ids:
-            qb_doc = HapiRequest.find_by_id('Questionnaire', qb_id)
-            self.sync_document(qb_doc)
-
-        # QuestionnaireResponse
-        for cp_id in cp_ids:
-            qrs = HapiRequest.find_bundle(
+        # Procedure, Questionnaire and QuestionnaireResponse
+        return careplans + self.sync_documents(
+            asyncio.run(self.fetch_related(cp_ids, qb_ids)))
+
+    @staticmethod
+    async def fetch_related(cp_ids, qb_ids):
+        """Concurrently fetch resources related to the given CarePlans
+
+        :param cp_ids: CarePlan ids, to find the Procedures and
+          QuestionnaireResponses based on each
+        :param qb_ids: Questionnaire ids to read
+        :returns: list of FHIR documents; Procedures, then Questionnaires,
+          then QuestionnaireResponses
+
+        """
+        hapi = AsyncHapiRequest()
+        procs = [
+            hapi.find_bundle("Procedure", {'based-on': f'CarePlan/{cp_id}'})
+            for cp_id in cp_ids]
+        qbs = [hapi.find_by_id('Questionnaire', qb_id) for qb_id in qb_ids]
+        qrs = [
+            hapi.find_bundle(
                 "QuestionnaireResponse", {'based-on': f'CarePlan/{cp_id}'})
-            for qr in Bundle(qrs).resources():
-                self.sync_document(qr)
+            for cp_id in cp_ids]
+        results = await asyncio.gather(*procs, *qbs, *qrs)
+
+        documents = []
+        for i, (result, status) in enumerate(results):
+            if len(procs) <= i < len(procs) + len(qbs):
+                documents.append(result)
+            else:
+                documents.extend(Bundle(result).resources())
+        return documents
@@ -1,5 +1,24 @@
 import couchdb
+from couchdb.http import (
+    HTTPError,
+    PreconditionFailed,
+    ResourceConflict,
+    ResourceNotFound,
+    Session,
+    Unauthorized,
+)
 from os import getenv
+import time
+from urllib.parse import urlsplit
+
+from ..timing import record_call
+
+ERROR_STATUS = {
+    PreconditionFailed: 412,
+    ResourceConflict: 409,
+    ResourceNotFound: 404,
+    Unauthorized: 401,
+}
 
 
 def _couch_url():
@@ -9,4 +28,44 @@ def _couch_url():
     return f"http://{user}:{password}@{host}:5984"
 
 
-couch = couchdb.Server(url=_couch_url())
+def normalise_couch_path(url):
+    """Returns path with user db name and document ids generalised"""
+    db, _, rest = urlsplit(url).path.lstrip('/').partition('/')
+    if db.startswith('userdb-'):
+        db = 'userdb-{id}'
+    if rest and not rest.startswith('_'):
+        rest = '{doc}'
+    return '/'.join((db, rest)) if rest else db
+
+
+class InstrumentedSession(Session):
+    """couchdb Session recording each request on the request timing"""
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.monotonic()
+        status, nbytes = None, None
+        try:
+            status, msg, data = super().request(method, url, *args, **kwargs)
+            nbytes = msg.get('Content-Length')
+            return status, msg, data
+        except HTTPError as e:
+            status = ERROR_STATUS.get(type(e), 500)
+            raise
+        finally:
+            record_call(
+                'couch', method, normalise_couch_path(url), status,
+                nbytes and int(nbytes), time.monotonic() - start)
+
+
+def db_updates(server, **options):
+    """Returns a page of the server's ``_db_updates`` feed
+
+    Not wrapped by couchdb-python.  Options are passed as query params,
+    i.e. ``since``, and ``feed='longpoll'`` with ``timeout`` (ms) to wait
+    for an update.
+    """
+    _, _, data = server.resource.get_json('_db_updates', **options)
+    return data
+
+
+couch = couchdb.Server(url=_couch_url(), session=InstrumentedSession())
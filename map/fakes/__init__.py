@@ -0,0 +1,15 @@
+"""In-process stand-ins for HAPI FHIR and CouchDB
+
+For exercising the HAPI and couch code paths, in tests and benchmarks,
+without any live services or network.  See ``FakeHapi``, ``FakeCouch``
+and the dataset generators in ``datasets``.
+"""
+from .couch import FakeCouch
+from .datasets import populate
+from .hapi import FakeHapi
+
+__all__ = [
+    'FakeCouch',
+    'FakeHapi',
+    'populate',
+]
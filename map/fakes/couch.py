@@ -0,0 +1,249 @@
+"""Fake CouchDB server, exposing the ``couchdb.Server`` API map.couch uses
+
+Substitute for ``map.couch.server.couch``, i.e.::
+
+    mocker.patch('map.couch.patient.couch', FakeCouch())
+
+"""
+from copy import deepcopy
+import time
+from uuid import uuid4
+
+from couchdb.client import Document, Row
+from couchdb.http import PreconditionFailed, ResourceConflict, ResourceNotFound
+
+from ..couch.patient import dbname_from_username
+
+
+def project_fields(doc, fields):
+    """Copy of doc with only the given, possibly dotted, fields; as Mango"""
+    if not fields:
+        return deepcopy(doc)
+    projected = {}
+    for field in fields:
+        source, target = doc, projected
+        *parents, name = field.split('.')
+        for parent in parents:
+            source = source.get(parent)
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(parent, {})
+        else:
+            if name in source:
+                target[name] = deepcopy(source[name])
+    return projected
+
+
+def check_options(request, options, supported):
+    """Raise ValueError naming any of the options the fake doesn't support"""
+    unsupported = sorted(set(options) - set(supported))
+    if unsupported:
+        raise ValueError(
+            f"fake {request} doesn't support {', '.join(unsupported)}")
+
+
+class FakeDatabase(object):
+    """In memory couch database"""
+
+    def __init__(self, name, latency=0, server=None):
+        self.name = name
+        self.latency = latency
+        self.server = server
+        self.docs = {}
+        self.request_count = 0
+        # update sequence, and that of each document's latest change
+        self.seq = 0
+        self.doc_seqs = {}
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.request_count += 1
+
+    def __contains__(self, id):
+        self._round_trip()
+        return id in self.docs
+
+    def __getitem__(self, id):
+        self._round_trip()
+        if id not in self.docs:
+            raise ResourceNotFound(('not_found', 'missing'))
+        return Document(deepcopy(self.docs[id]))
+
+    def __setitem__(self, id, content):
+        self._round_trip()
+        content.update(self.put(id, content))
+
+    def get(self, id, default=None):
+        self._round_trip()
+        if id not in self.docs:
+            return default
+        return Document(deepcopy(self.docs[id]))
+
+    def changes(self, since=0, **opts):
+        """Changes feed (normal, not continuous); ``since`` 'now' or a seq"""
+        check_options('_changes', opts, ('include_docs', 'limit'))
+        self._round_trip()
+        if since == 'now':
+            return {'results': [], 'last_seq': self.seq}
+        results = []
+        for id, seq in sorted(self.doc_seqs.items(), key=lambda i: i[1]):
+            if seq <= int(since):
+                continue
+            change = {
+                'id': id, 'seq': seq,
+                'changes': [{'rev': self.docs[id]['_rev']}]}
+            if opts.get('include_docs'):
+                change['doc'] = deepcopy(self.docs[id])
+            results.append(change)
+            if len(results) == opts.get('limit'):
+                return {'results': results, 'last_seq': seq}
+        return {'results': results, 'last_seq': self.seq}
+
+    def __len__(self):
+        # as couch's doc_count, local documents excluded
+        return len([id for id in self.docs if not id.startswith('_local/')])
+
+    def __bool__(self):
+        # as couchdb.Database, truthy when exists regardless of doc count
+        return True
+
+    def view(self, name, wrapper=None, **options):
+        """Query ``_all_docs``; design views aren't supported
+
+        All rows, ordered by key, unless limited to the given ``keys``
+        """
+        if name != '_all_docs':
+            raise ValueError(f"fake doesn't support view {name}")
+        check_options(name, options, ('keys', 'include_docs'))
+        self._round_trip()
+        keys = options.get('keys')
+        if keys is None:
+            keys = sorted(
+                id for id in self.docs if not id.startswith('_local/'))
+        rows = []
+        for key in keys:
+            if key not in self.docs:
+                rows.append(Row(key=key, error='not_found'))
+                continue
+            row = Row(
+                id=key, key=key, value={'rev': self.docs[key]['_rev']})
+            if options.get('include_docs'):
+                row['doc'] = deepcopy(self.docs[key])
+            rows.append(row)
+        return rows
+
+    def find(self, mango_query, wrapper=None):
+        """Mango ``_find`` by ``_id`` ``$in`` selector, in ``_id`` order"""
+        check_options('_find', mango_query, ('selector', 'fields', 'limit'))
+        selector = mango_query['selector']
+        if list(selector) != ['_id'] or list(selector['_id']) != ['$in']:
+            raise ValueError(f"fake _find doesn't support selector {selector}")
+        self._round_trip()
+        ids = sorted(set(selector['_id']['$in']) & set(self.docs))
+        docs = [
+            project_fields(self.docs[id], mango_query.get('fields'))
+            for id in ids[:mango_query.get('limit', 25)]]
+        return map(wrapper or Document, docs)
+
+    def update(self, documents, **options):
+        """Bulk write (``_bulk_docs``); returns (success, id, rev_or_exc)"""
+        self._round_trip()
+        results = []
+        for doc in documents:
+            try:
+                doc.update(self.put(doc['_id'], doc))
+            except ResourceConflict as e:
+                results.append((False, doc['_id'], e))
+            else:
+                results.append((True, doc['_id'], doc['_rev']))
+        return results
+
+    def put(self, id, content):
+        """Store copy of content with new revision; returns _id and _rev
+
+        :raises ResourceConflict: unless _rev matches that stored
+        """
+        current = self.docs.get(id)
+        if current and content.get('_rev') != current['_rev']:
+            raise ResourceConflict(('conflict', 'Document update conflict.'))
+        generation = int(current['_rev'].split('-')[0]) + 1 if current else 1
+        stored = deepcopy(dict(content))
+        stored.update({'_id': id, '_rev': f"{generation}-{uuid4().hex}"})
+        self.docs[id] = stored
+        if not id.startswith('_local/'):
+            self.seq += 1
+            self.doc_seqs[id] = self.seq
+            if self.server is not None:
+                self.server.updated(self.name)
+        return {'_id': id, '_rev': stored['_rev']}
+
+
+class FakeCouch(object):
+    """In memory couch server, with ``couch_peruser`` behaviour
+
+    :param latency: seconds to sleep per request, simulating a round trip
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.databases = {}
+        self.users = {}
+        # ``_db_updates`` feed; latest sequence of each updated db
+        self.seq = 0
+        self.db_seqs = {}
+        self.resource = FakeResource(self)
+
+    def __contains__(self, name):
+        return name in self.databases
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            raise ResourceNotFound(('not_found', 'Database does not exist.'))
+        return self.databases[name]
+
+    def create(self, name):
+        if name in self.databases:
+            raise PreconditionFailed(('file_exists', 'The database exists.'))
+        self.databases[name] = FakeDatabase(
+            name, latency=self.latency, server=self)
+        self.updated(name)
+        return self.databases[name]
+
+    def updated(self, name):
+        self.seq += 1
+        self.db_seqs[name] = self.seq
+
+    def db_updates(self, since=0, **options):
+        """``_db_updates`` feed; a longpoll with nothing new returns at once"""
+        check_options('_db_updates', options, ('feed', 'timeout'))
+        if options.get('feed', 'normal') not in ('normal', 'longpoll'):
+            raise ValueError(
+                f"fake _db_updates doesn't support feed {options['feed']}")
+        if since == 'now':
+            return {'results': [], 'last_seq': self.seq}
+        return {
+            'results': [
+                {'db_name': name, 'type': 'updated', 'seq': seq}
+                for name, seq in sorted(
+                    self.db_seqs.items(), key=lambda i: i[1])
+                if seq > int(since)],
+            'last_seq': self.seq}
+
+    def add_user(self, name, password, roles=None):
+        """Add user, and as ``couch_peruser`` does, the user's db"""
+        self.users[name] = {'name': name, 'roles': roles or []}
+        self.create(dbname_from_username(name))
+        return f"org.couchdb.user:{name}", "1-fake"
+
+
+class FakeResource(object):
+    """Server level ``resource``, answering ``_db_updates`` requests"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def get_json(self, path, **params):
+        if path != '_db_updates':
+            raise ValueError(f"fake server doesn't support {path}")
+        return 200, {}, self.server.db_updates(**params)
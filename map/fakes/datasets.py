@@ -0,0 +1,115 @@
+"""Dataset generators, populating a ``FakeHapi`` with realistic shapes"""
+from itertools import cycle
+
+KEYCLOAK_SYSTEM = "https://keycloak.example.org/auth/realms/Stayhome"
+DEFAULT_CAREPLAN_ID = '54'
+TEMPLATE_CAREPLAN_ID = '1058'
+CONSENT_CLASSES = ('research', 'notifications', 'sharing')
+
+
+def questionnaire(qid):
+    return {
+        'resourceType': 'Questionnaire', 'id': qid, 'status': 'active',
+        'item': [{'linkId': str(i), 'type': 'string', 'text': f"Item {i}"}
+                 for i in range(10)]}
+
+
+def careplan(cp_id, questionnaire_ids, patient_id=None):
+    doc = {
+        'resourceType': 'CarePlan', 'id': cp_id, 'status': 'active',
+        'intent': 'plan',
+        'activity': [{'detail': {
+            'instantiatesCanonical': [f"Questionnaire/{qid}"],
+            'status': 'scheduled', 'doNotPerform': False,
+            'description': f"Questionnaire {qid}"}}
+            for qid in questionnaire_ids]}
+    if patient_id:
+        doc['subject'] = {'reference': f"Patient/{patient_id}"}
+        doc['basedOn'] = [{'reference': f"CarePlan/{TEMPLATE_CAREPLAN_ID}"}]
+    return doc
+
+
+def patient(patient_id, org_id):
+    return {
+        'resourceType': 'Patient', 'id': patient_id,
+        'identifier': [{
+            'system': KEYCLOAK_SYSTEM, 'value': f"kc-subject-{patient_id}"}],
+        'name': [{'family': f"Family{patient_id}", 'given': ['Test']}],
+        'gender': 'unknown', 'birthDate': '1970-01-01',
+        'managingOrganization': {'reference': f"Organization/{org_id}"}}
+
+
+def consent(consent_id, patient_id, org_id, provision_class):
+    return {
+        'resourceType': 'Consent', 'id': consent_id, 'status': 'active',
+        'patient': {'reference': f"Patient/{patient_id}"},
+        'organization': [{'reference': f"Organization/{org_id}"}],
+        'period': {'start': '2020-04-01T00:00:00+00:00'},
+        'provision': {'type': 'permit', 'class': [{
+            'system': 'https://stayhome.app/consent-class',
+            'code': provision_class}]}}
+
+
+def populate(
+        fake_hapi, patients=10, consents=10, careplans=10,
+        organizations=3, questionnaires=5, resources_per_careplan=2):
+    """Fill fake_hapi with related test data; returns dict of ids by type
+
+    :param patients: number of Patients, spread over the organizations
+    :param consents: number of Consents, assigned to patients round robin
+    :param careplans: number of patient CarePlans, assigned round robin,
+      besides the default (id 54) and template (id 1058) CarePlans
+    :param resources_per_careplan: number of Procedures and of
+      QuestionnaireResponses based on each patient CarePlan
+
+    """
+    ids = {}
+    ids['Organization'] = [str(1463 + i) for i in range(organizations)]
+    for org_id in ids['Organization']:
+        fake_hapi.store({
+            'resourceType': 'Organization', 'id': org_id,
+            'name': f"Organization {org_id}"})
+
+    ids['Questionnaire'] = [str(1300 + i) for i in range(questionnaires)]
+    for qid in ids['Questionnaire']:
+        fake_hapi.store(questionnaire(qid))
+    fake_hapi.store(careplan(DEFAULT_CAREPLAN_ID, ids['Questionnaire'][:2]))
+    fake_hapi.store(careplan(TEMPLATE_CAREPLAN_ID, ids['Questionnaire']))
+
+    orgs = cycle(ids['Organization'])
+    ids['Patient'] = [
+        fake_hapi.store(patient(None, next(orgs)))['id']
+        for _ in range(patients)]
+
+    patient_ids = cycle(ids['Patient'])
+    classes = cycle(CONSENT_CLASSES)
+    ids['Consent'] = []
+    for _ in range(consents):
+        pat_id = next(patient_ids)
+        org_id = fake_hapi.get('Patient', pat_id)['managingOrganization'][
+            'reference'].split('/')[1]
+        ids['Consent'].append(fake_hapi.store(
+            consent(None, pat_id, org_id, next(classes)))['id'])
+
+    patient_ids = cycle(ids['Patient'])
+    ids.update({'CarePlan': [], 'Procedure': [], 'QuestionnaireResponse': []})
+    for _ in range(careplans):
+        pat_id = next(patient_ids)
+        cp_id = fake_hapi.store(
+            careplan(None, ids['Questionnaire'], pat_id))['id']
+        ids['CarePlan'].append(cp_id)
+        for i in range(resources_per_careplan):
+            based_on = [{'reference': f"CarePlan/{cp_id}"}]
+            ids['Procedure'].append(fake_hapi.store({
+                'resourceType': 'Procedure', 'status': 'completed',
+                'subject': {'reference': f"Patient/{pat_id}"},
+                'basedOn': based_on})['id'])
+            ids['QuestionnaireResponse'].append(fake_hapi.store({
+                'resourceType': 'QuestionnaireResponse',
+                'status': 'completed',
+                'questionnaire': f"Questionnaire/{ids['Questionnaire'][0]}",
+                'subject': {'reference': f"Patient/{pat_id}"},
+                'basedOn': based_on,
+                'item': [{'linkId': '0', 'answer': [{'valueString': 'x'}]}],
+            })['id'])
+    return ids
@@ -0,0 +1,371 @@
+"""Fake HAPI FHIR server, served in process via a ``requests`` adapter
+
+Covers the subset of the FHIR REST API ``HapiRequest`` uses: search (with
+``_include``, ``_count``, ``_elements``, ``_sort`` by ``_lastUpdated``
+and paging links), read with ETags, create, update, delete, type level
+``_history`` and batch/transaction Bundles.
+"""
+from copy import deepcopy
+from datetime import datetime, timezone
+from itertools import count
+import json
+import time
+from urllib.parse import parse_qsl, urlsplit
+from uuid import uuid4
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from ..fhir.projection import SUBSETTED, project
+from ..utils import dt_or_none
+
+DEFAULT_COUNT = 20
+
+
+def reference_values(value):
+    """Returns all ``reference`` strings within a Reference or list thereof"""
+    if isinstance(value, list):
+        return [v.get('reference') for v in value]
+    if isinstance(value, dict):
+        return [value.get('reference')]
+    return []
+
+
+def match_reference(references, search_value):
+    """True if any reference matches search value, i.e. "CarePlan/12" or "12"
+
+    A comma separated search value matches any of its values.
+    """
+    for ref in references:
+        for value in search_value.split(','):
+            if ref and (ref == value or ref.endswith('/' + value)):
+                return True
+    return False
+
+
+def match_identifier(resource, search_value):
+    system, _, value = search_value.rpartition('|')
+    return any(
+        i.get('value') == value and (not system or i.get('system') == system)
+        for i in resource.get('identifier', []))
+
+
+def match_last_updated(resource, search_value):
+    """Supports ``gt``, ``ge``, ``lt`` and ``le`` prefixes, as HAPI does"""
+    prefix, when = search_value[:2], search_value[2:]
+    if prefix not in ('gt', 'ge', 'lt', 'le'):
+        prefix, when = 'eq', search_value
+    last_updated = resource.get('meta', {}).get('lastUpdated', '')
+    if not last_updated:
+        return False
+    updated, when = parse_instant(last_updated), parse_instant(when)
+    return {
+        'gt': updated > when, 'ge': updated >= when,
+        'lt': updated < when, 'le': updated <= when,
+        'eq': updated == when}[prefix]
+
+
+def parse_instant(value):
+    result = dt_or_none(value)
+    if result.tzinfo is None:
+        result = result.replace(tzinfo=timezone.utc)
+    return result
+
+
+# Supported search parameters, with their matching functions
+SEARCH_PARAMS = {
+    '_id': lambda r, v: r['id'] in v.split(','),
+    '_lastUpdated': match_last_updated,
+    'based-on': lambda r, v: match_reference(
+        reference_values(r.get('basedOn')), v),
+    'identifier': match_identifier,
+    'organization': lambda r, v: match_reference(
+        reference_values(r.get('organization')), v),
+    'patient': lambda r, v: match_reference(
+        reference_values(r.get('patient')), v),
+    'status': lambda r, v: r.get('status') in v.split(','),
+    'subject': lambda r, v: match_reference(
+        reference_values(r.get('subject')), v),
+}
+
+
+class FakeHapi(BaseAdapter):
+    """In memory FHIR store, answering requests sent to the mounted url
+
+    Mount on a ``requests.Session``, such as ``HapiRequest.session``::
+
+        fake = FakeHapi(base_url='http://fake-hapi/fhir/')
+        fake.mount(HapiRequest.session)
+
+    :param base_url: url prefix the fake answers, ending with '/'
+    :param latency: seconds to sleep per request, simulating a round trip
+
+    """
+
+    def __init__(self, base_url='http://fake-hapi/fhir/', latency=0):
+        super().__init__()
+        self.base_url = base_url
+        self.latency = latency
+        self.resources = {}
+        # (resourceType, id, versionId, lastUpdated, method) of each change
+        self.history = []
+        self.searches = {}
+        self.request_count = 0
+        self._next_id = count(10000)
+
+    def mount(self, session):
+        session.mount(self.base_url, self)
+
+    def close(self):
+        pass
+
+    # In memory store ##############################################
+
+    def store(self, resource):
+        """Create or update resource, maintaining ``meta``; return copy"""
+        resource = deepcopy(resource)
+        if not resource.get('id'):
+            resource['id'] = str(next(self._next_id))
+        by_type = self.resources.setdefault(resource['resourceType'], {})
+        existing = by_type.get(resource['id'])
+        version = int(existing['meta']['versionId']) + 1 if existing else 1
+        resource['meta'] = dict(
+            resource.get('meta', {}),
+            versionId=str(version),
+            lastUpdated=datetime.now(timezone.utc).isoformat())
+        by_type[resource['id']] = resource
+        self.history.append((
+            resource['resourceType'], resource['id'], str(version),
+            resource['meta']['lastUpdated'], 'PUT' if existing else 'POST'))
+        return deepcopy(resource)
+
+    def delete(self, resource_type, resource_id):
+        """Delete resource, recording the deletion in its history"""
+        resource = self.resources[resource_type].pop(resource_id)
+        self.history.append((
+            resource_type, resource_id,
+            str(int(resource['meta']['versionId']) + 1),
+            datetime.now(timezone.utc).isoformat(), 'DELETE'))
+
+    def get(self, resource_type, resource_id):
+        return self.resources.get(resource_type, {}).get(str(resource_id))
+
+    def search(self, resource_type, params):
+        """Returns list of matching resources, with any _include'd"""
+        matches = []
+        for resource in self.resources.get(resource_type, {}).values():
+            if all(SEARCH_PARAMS[k](resource, v)
+                   for k, v in params if k in SEARCH_PARAMS):
+                matches.append(resource)
+        sort = dict(params).get('_sort', '')
+        if sort.lstrip('-') == '_lastUpdated':
+            matches.sort(
+                key=lambda r: parse_instant(r['meta']['lastUpdated']),
+                reverse=sort.startswith('-'))
+
+        included = []
+        for k, v in params:
+            if k != '_include':
+                continue
+            _, element = v.split('.')
+            for resource in matches:
+                for ref in reference_values(resource.get(element)):
+                    target = ref and self.get(*ref.split('/'))
+                    if target and target not in included:
+                        included.append(target)
+        return [('match', r) for r in matches] + [
+            ('include', r) for r in included]
+
+    # Transport ####################################################
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.request_count += 1
+
+        url = urlsplit(request.url)
+        path = request.url[len(self.base_url):].split('?')[0].strip('/')
+        params = parse_qsl(url.query)
+        body = json.loads(request.body) if request.body else None
+        status, payload, headers = self.handle(
+            request.method, path, params, body, request.headers)
+        return self.build_response(request, status, payload, headers)
+
+    def build_response(self, request, status, payload, headers=None):
+        response = Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers or {})
+        response.headers.setdefault(
+            'Content-Type', 'application/fhir+json;charset=UTF-8')
+        response._content = (
+            json.dumps(payload).encode('utf-8') if payload is not None
+            else b'')
+        response._content_consumed = True
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.reason = str(status)
+        return response
+
+    def handle(self, method, path, params, body, headers=None):
+        """Returns (status, payload, headers) for the given request"""
+        parts = path.split('/') if path else []
+        if method == 'GET' and not parts:
+            return self.handle_page(dict(params))
+        if method == 'POST' and not parts:
+            return self.handle_bundle(body)
+        if method == 'GET' and len(parts) == 1:
+            return self.handle_search(parts[0], params)
+        if method == 'POST' and len(parts) == 1:
+            body.pop('id', None)
+            resource = self.store(body)
+            return 201, resource, self.etag(resource)
+        if len(parts) != 2:
+            return operation_outcome(400, f"unsupported path {path}")
+        if method == 'GET' and parts[1] == '_history':
+            return self.handle_history(parts[0], params)
+
+        resource_type, resource_id = parts
+        if method == 'PUT':
+            created = self.get(resource_type, resource_id) is None
+            resource = self.store(dict(body, id=resource_id))
+            return 201 if created else 200, resource, self.etag(resource)
+
+        resource = self.get(resource_type, resource_id)
+        if resource is None:
+            return operation_outcome(404, f"{path} not found")
+        if method == 'DELETE':
+            self.delete(resource_type, resource_id)
+            return operation_outcome(200, f"deleted {path}")
+        etag = self.etag(resource)
+        if headers and headers.get('If-None-Match') == etag['ETag']:
+            return 304, None, etag
+        elements = dict(params).get('_elements')
+        if elements:
+            resource = subset(resource, elements)
+        return 200, deepcopy(resource), etag
+
+    @staticmethod
+    def etag(resource):
+        return {'ETag': f'W/"{resource["meta"]["versionId"]}"'}
+
+    def handle_search(self, resource_type, params):
+        search_id = uuid4().hex
+        self.searches[search_id] = {
+            'results': self.search(resource_type, params),
+            'elements': dict(params).get('_elements')}
+        page_size = int(dict(params).get('_count', DEFAULT_COUNT))
+        return 200, self.page(search_id, 0, page_size), None
+
+    def handle_history(self, resource_type, params):
+        """Type level ``_history``, newest first, optionally ``_since``"""
+        since = dict(params).get('_since')
+        entries = []
+        for type_, id, version, updated, method in reversed(self.history):
+            if type_ != resource_type or (
+                    since and parse_instant(updated) < parse_instant(since)):
+                continue
+            entry = {
+                'fullUrl': f"{self.base_url}{type_}/{id}",
+                'request': {'method': method, 'url': f"{type_}/{id}"}}
+            current = self.get(type_, id)
+            if method != 'DELETE' and current and (
+                    current['meta']['versionId'] == version):
+                entry['resource'] = current
+            entries.append(('history', entry))
+
+        search_id = uuid4().hex
+        self.searches[search_id] = {
+            'results': entries, 'elements': None, 'type': 'history'}
+        page_size = int(dict(params).get('_count', DEFAULT_COUNT))
+        return 200, self.page(search_id, 0, page_size), None
+
+    def handle_page(self, params):
+        if params.get('_getpages') not in self.searches:
+            return operation_outcome(410, "search expired or unknown")
+        return 200, self.page(
+            params['_getpages'], int(params.get('_getpagesoffset', 0)),
+            int(params.get('_count', DEFAULT_COUNT))), None
+
+    def page(self, search_id, offset, page_size):
+        """Returns searchset Bundle for the requested page of results"""
+        search = self.searches[search_id]
+        results = search['results']
+        matches = sum(1 for mode, _ in results if mode != 'include')
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': search.get('type', 'searchset'),
+            'total': matches,
+            'link': [{'relation': 'self', 'url': self.page_url(
+                search_id, offset, page_size)}]}
+        if offset + page_size < len(results):
+            bundle['link'].append({'relation': 'next', 'url': self.page_url(
+                search_id, offset + page_size, page_size)})
+        entries = []
+        for mode, resource in results[offset:offset + page_size]:
+            if mode == 'history':
+                # already a history entry, holding any resource version
+                entries.append(deepcopy(resource))
+                continue
+            if search['elements']:
+                resource = subset(resource, search['elements'])
+            entries.append({
+                'fullUrl': f"{self.base_url}{resource['resourceType']}/"
+                           f"{resource['id']}",
+                'resource': deepcopy(resource),
+                'search': {'mode': mode}})
+        if entries:
+            bundle['entry'] = entries
+        return bundle
+
+    def page_url(self, search_id, offset, page_size):
+        return (
+            f"{self.base_url}?_getpages={search_id}"
+            f"&_getpagesoffset={offset}&_count={page_size}")
+
+    def handle_bundle(self, bundle):
+        """Process batch or transaction Bundle; not truly atomic"""
+        entries = []
+        for entry in bundle.get('entry', []):
+            request = entry['request']
+            path, _, query = request['url'].partition('?')
+            status, payload, headers = self.handle(
+                request['method'], path, parse_qsl(query),
+                entry.get('resource'))
+            response = {'status': f"{status} {STATUS_TEXT.get(status, '')}"}
+            if headers and 'ETag' in headers:
+                response['etag'] = headers['ETag']
+            result = {'response': response}
+            if payload and payload.get('resourceType') == 'OperationOutcome':
+                response['outcome'] = payload
+            elif payload:
+                result['resource'] = payload
+            entries.append(result)
+        return 200, {
+            'resourceType': 'Bundle',
+            'type': f"{bundle['type']}-response",
+            'entry': entries}, None
+
+
+STATUS_TEXT = {
+    200: 'OK', 201: 'Created', 304: 'Not Modified', 400: 'Bad Request',
+    404: 'Not Found', 410: 'Gone'}
+
+
+def subset(resource, elements):
+    """Apply ``_elements`` as HAPI does, tagging the result SUBSETTED"""
+    result = project(resource, elements.split(','))
+    meta = dict(result.get('meta', {}))
+    meta['tag'] = meta.get('tag', []) + [SUBSETTED]
+    result['meta'] = meta
+    return result
+
+
+def operation_outcome(status, diagnostics):
+    return status, {
+        'resourceType': 'OperationOutcome',
+        'issue': [{
+            'severity': 'error' if status >= 400 else 'information',
+            'code': 'processing',
+            'diagnostics': diagnostics}]}, None
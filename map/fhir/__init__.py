@@ -1,4 +1,5 @@
-from .bundle import Bundle
+from .async_hapi import AsyncHapiRequest
+from .bundle import Bundle, PagedBundle
 from .careplan import CarePlan
 from .hapi import HapiRequest
 from .identifier import (
@@ -14,9 +15,11 @@ __all__ = [
     'IDENTIFIER',
     'SYSTEM',
     'VALUE',
+    'AsyncHapiRequest',
     'Bundle',
     'CarePlan',
     'HapiRequest',
+    'PagedBundle',
     'ResourceType',
     'update_identifier',
 ]
@@ -0,0 +1,61 @@
+import asyncio
+from functools import partial
+
+from flask import current_app, g
+
+from .hapi import HapiRequest
+
+
+class AsyncHapiRequest(object):
+    """Awaitable counterpart of ``HapiRequest``, same method surface
+
+    Each call runs the matching blocking ``HapiRequest`` method on the
+    event loop's default executor, within the app context captured at
+    construction, so calls share the process-wide pooled session.  A
+    semaphore bounds the number of upstream requests in flight.
+
+    Construct from within a coroutine, so the semaphore binds to the
+    running loop.  Any deadline and request timing in effect at
+    construction carry over to the executed calls.
+    """
+
+    def __init__(self, max_concurrency=None):
+        self.app = current_app._get_current_object()
+        if max_concurrency is None:
+            max_concurrency = self.app.config.get("HAPI_MAX_CONCURRENCY")
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.deadline = g.get('hapi_deadline')
+        self.timing = g.get('timing')
+
+    def _in_app_context(self, method_name, *args, **kwargs):
+        with self.app.app_context():
+            g.hapi_deadline = self.deadline
+            g.timing = self.timing
+            return getattr(HapiRequest, method_name)(*args, **kwargs)
+
+    async def _call(self, method_name, *args, **kwargs):
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, partial(
+                self._in_app_context, method_name, *args, **kwargs))
+
+    async def find_bundle(self, resource_type, search_dict, elements=None):
+        return await self._call(
+            'find_bundle', resource_type, search_dict, elements=elements)
+
+    async def find_one(self, resource_type, search_dict, elements=None):
+        return await self._call(
+            'find_one', resource_type, search_dict, elements=elements)
+
+    async def find_by_id(self, resource_type, resource_id, elements=None):
+        return await self._call(
+            'find_by_id', resource_type, resource_id, elements=elements)
+
+    async def delete_by_id(self, resource_type, resource_id):
+        return await self._call('delete_by_id', resource_type, resource_id)
+
+    async def post_resource(self, resource):
+        return await self._call('post_resource', resource)
+
+    async def put_resource(self, resource):
+        return await self._call('put_resource', resource)
@@ -25,18 +25,73 @@ class Bundle(object):
         :param ids: iterable of id values to remove from bundle
         :raises ValueError: if matching entries not found
         """
+        ids = set(ids)
+        found = set()
+
+        def keep(resource):
+            if resource['id'] in ids:
+                found.add(resource['id'])
+                return False
+            return True
+
         count_b4 = len(self)
-        keepers = []
-        found_count = 0
-        for i in self.bundle['entry']:
-            if i['resource']['id'] not in ids:
-                keepers.append(i)
-            else:
-                found_count += 1
-
-        if found_count != len(ids):
+        keepers = [i for i in self.bundle['entry'] if keep(i['resource'])]
+        if found != ids:
             raise ValueError(f"unable to remove all {ids}; can't continue")
 
         if 'total' in self.bundle:
-            self.bundle['total'] = count_b4 - found_count
+            self.bundle['total'] = count_b4 - (
+                len(self.bundle['entry']) - len(keepers))
         self.bundle['entry'] = keepers
+
+    def filter_entries(self, keep):
+        """retain only entries for which ``keep(resource)`` is true
+
+        Single pass over the entries; ``total``, if defined, is reduced by
+        the number removed.
+
+        :returns: number of entries removed
+        """
+        entries = self.bundle.get('entry', [])
+        keepers = [i for i in entries if keep(i['resource'])]
+        removed = len(entries) - len(keepers)
+        if removed:
+            if 'total' in self.bundle:
+                self.bundle['total'] -= removed
+            self.bundle['entry'] = keepers
+        return removed
+
+
+class PagedBundle(Bundle):
+    """Bundle API over a lazy stream of search result pages
+
+    Wraps an iterable of Bundle pages, such as ``HapiRequest.iter_pages``.
+    Only the current page is held in ``self.bundle``, therefore
+    ``resources()`` may only be consumed once.
+    """
+
+    def __init__(self, pages):
+        self.pages = iter(pages)
+        super().__init__(next(self.pages))
+
+    def __len__(self):
+        """Return `total` of the search, the only size known up front"""
+        if 'total' not in self.bundle:
+            raise ValueError("length unknown for paged bundle w/o total")
+        return self.bundle["total"]
+
+    def resources(self):
+        """generator to return each resource from every page"""
+        while True:
+            for entry in self.bundle.get('entry', []):
+                yield entry["resource"]
+            page = next(self.pages, None)
+            if page is None:
+                return
+            self.bundle = page
+
+    def remove_entries(self, ids):
+        raise TypeError("can't remove entries from a paged bundle")
+
+    def filter_entries(self, keep):
+        raise TypeError("can't remove entries from a paged bundle")
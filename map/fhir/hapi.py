@@ -1,7 +1,35 @@
+import codecs
+from contextlib import closing
+from copy import deepcopy
+import os
+import time
+
 import requests
-from flask import current_app
+from flask import current_app, g, has_app_context
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    MaxRetryError,
+    ReadTimeoutError,
+)
+from urllib3.util.retry import Retry
+from werkzeug.exceptions import GatewayTimeout, ServiceUnavailable
+
+from ..commons.breaker import CircuitBreaker
+from ..commons.cache import TTLCache
+from ..commons.singleflight import SingleFlight
+from ..timing import record_call, timed_phase
+from .projection import is_subsetted, project, project_bundle, with_elements
+from .stream import iter_bundle_entries
 
 ACCEPT_JSON = {'Accept': 'application/json'}
+STREAM_CHUNK_SIZE = 64 * 1024
+
+try:
+    import brotli  # noqa: F401 - enables urllib3 br decoding
+    ACCEPT_ENCODINGS = ('gzip', 'br', 'deflate')
+except ImportError:  # pragma: no cover
+    ACCEPT_ENCODINGS = ('gzip', 'deflate')
 
 
 class HapiMeta(type):
@@ -12,6 +40,148 @@ class HapiMeta(type):
             cls._base_url = current_app.config.get("HAPI_URL")
         return cls._base_url
 
+    @property
+    def session(cls):
+        """Pooled, keep-alive session shared by all requests in process
+
+        Built on first use, and rebuilt if the process id changes, so each
+        forked (gunicorn) worker gets its own connection pool rather than
+        sharing sockets inherited from the parent.
+        """
+        if getattr(cls, '_session_pid', None) != os.getpid():
+            cls._session = build_session(
+                pool_size=current_app.config.get("HAPI_POOL_SIZE"),
+                max_retries=current_app.config.get("HAPI_MAX_RETRIES"))
+            cls._session_pid = os.getpid()
+        return cls._session
+
+    @property
+    def resource_cache(cls):
+        """Process-wide cache of resources read by id, with their ETag"""
+        if getattr(cls, '_resource_cache', None) is None:
+            cls._resource_cache = TTLCache(
+                max_size=current_app.config.get("HAPI_CACHE_SIZE"),
+                ttl=current_app.config.get("HAPI_CACHE_TTL"))
+        return cls._resource_cache
+
+    def circuit_breaker(cls, endpoint):
+        """Return the process-wide circuit breaker for given endpoint"""
+        if getattr(cls, '_breakers', None) is None:
+            cls._breakers = {}
+        if endpoint not in cls._breakers:
+            cls._breakers[endpoint] = CircuitBreaker(
+                failure_threshold=current_app.config.get(
+                    "HAPI_BREAKER_THRESHOLD"),
+                reset_timeout=current_app.config.get("HAPI_BREAKER_RESET"))
+        return cls._breakers[endpoint]
+
+
+def start_deadline(budget=None):
+    """Start the time budget for HAPI calls made within this app context
+
+    Typically called at the start of each API request.  Each subsequent
+    HAPI call is limited to the time remaining.
+    """
+    if budget is None:
+        budget = current_app.config.get("REQUEST_TIME_BUDGET")
+    g.hapi_deadline = time.monotonic() + budget if budget else None
+
+
+def remaining_time():
+    """Return seconds remaining in the current deadline, None if unset"""
+    deadline = g.get('hapi_deadline') if has_app_context() else None
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def endpoint_key(path):
+    """Return the HAPI endpoint (i.e. resource type) for circuit breaking"""
+    if '://' in path:
+        # paging links and the like
+        return '_getpages'
+    return path.split('?')[0].split('/')[0]
+
+
+def json_body(response):
+    """Return the decoded JSON body of a HAPI response
+
+    Timed as the request's ``json`` phase, apart from the HAPI call.
+    """
+    with timed_phase('json'):
+        return response.json()
+
+
+def next_link(bundle):
+    """Return url of Bundle's next page, if defined"""
+    return next((
+        link['url'] for link in bundle.get('link', [])
+        if link.get('relation') == 'next'), None)
+
+
+def canonical_search(resource_type, search_dict):
+    """Return hashable key for search, independent of parameter order"""
+    if hasattr(search_dict, 'lists'):
+        # werkzeug MultiDict, such as ``request.args``
+        items = search_dict.lists()
+    else:
+        items = (
+            (k, v if isinstance(v, (list, tuple)) else [v])
+            for k, v in search_dict.items())
+    return resource_type, tuple(sorted(
+        (k, tuple(sorted(str(i) for i in v))) for k, v in items))
+
+
+class DeadlineRetry(Retry):
+    """Retry policy bounded by the current deadline (see ``start_deadline``)
+
+    Every attempt reuses the timeouts computed for the first, so while a
+    deadline is set timed out attempts aren't retried, and no attempt is
+    retried once the deadline has passed.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(
+            self, method=None, url=None, response=None, error=None,
+            _pool=None, _stacktrace=None):
+        remaining = remaining_time()
+        if remaining is not None and error is not None and (
+                remaining <= 0 or
+                isinstance(error, (ConnectTimeoutError, ReadTimeoutError))):
+            if isinstance(error, ReadTimeoutError):
+                raise error.with_traceback(_stacktrace)
+            raise MaxRetryError(_pool, url, error) from error
+        return super().increment(
+            method, url, response=response, error=error, _pool=_pool,
+            _stacktrace=_stacktrace)
+
+
+def build_session(pool_size, max_retries):
+    """Return a ``requests.Session`` with a sized pool and retry policy
+
+    Retries apply to connection errors and gateway statuses only, and
+    only for idempotent methods (urllib3 defaults exclude POST).  See
+    ``DeadlineRetry`` for limits while a deadline is set.
+    """
+    retry = DeadlineRetry(
+        total=max_retries,
+        backoff_factor=0.1,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=retry)
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = ', '.join(ACCEPT_ENCODINGS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 
 class HapiRequest(metaclass=HapiMeta):
     """Methods to execute remote request, returning (json results, status)"""
@@ -20,24 +190,217 @@ class HapiRequest(metaclass=HapiMeta):
     def build_request(cls, path):
         if path is None:
             raise ValueError("can't request w/o path!")
+        if '://' in path:
+            # already absolute, such as a Bundle paging link
+            return path
         if cls.base_url is None:
             raise ValueError("config error; can't request w/o base_url")
         return cls.base_url + path
 
     @classmethod
-    def find_bundle(cls, resource_type, search_dict):
-        """Search for bundled results from given params and return"""
+    def timeout(cls):
+        """Return (connect, read) timeout tuple
+
+        Configured values, capped by the time remaining in the current
+        deadline (see ``start_deadline``) if one is set.
+
+        :raises GatewayTimeout: if the deadline has already passed
+        """
+        connect = current_app.config.get("HAPI_CONNECT_TIMEOUT")
+        read = current_app.config.get("HAPI_READ_TIMEOUT")
+        remaining = remaining_time()
+        if remaining is None:
+            return connect, read
+        if remaining <= 0:
+            raise GatewayTimeout("time budget exhausted before HAPI call")
+        return min(connect, remaining), min(read, remaining)
+
+    @classmethod
+    def request(cls, method, path, **kwargs):
+        """Execute request on the pooled session; raise on HTTP errors
+
+        Calls are refused while the endpoint's circuit breaker is open,
+        which server errors, timeouts and connection failures trip.  A
+        timeout cut short by the current deadline doesn't count against
+        the endpoint.
+
+        :param method: HTTP verb, i.e. 'GET'
+        :param path: path relative to the HAPI base url
+        :param kwargs: passed through to ``requests.Session.request``
+        :returns: the ``requests.Response``
+        :raises ServiceUnavailable: if circuit open or HAPI unreachable
+        :raises GatewayTimeout: if HAPI doesn't respond in time
+
+        """
+        kwargs.setdefault('headers', ACCEPT_JSON)
+        kwargs.setdefault('timeout', cls.timeout())
+        configured_timeout = kwargs['timeout'] == (
+            current_app.config.get("HAPI_CONNECT_TIMEOUT"),
+            current_app.config.get("HAPI_READ_TIMEOUT"))
+        endpoint = endpoint_key(path)
+        breaker = cls.circuit_breaker(endpoint)
+        if not breaker.allow():
+            raise ServiceUnavailable(f"HAPI {endpoint} currently unavailable")
+
+        start = time.monotonic()
+        # Recorded whatever is raised, else a half-open breaker's trial
+        # would never complete, leaving the circuit open for good.  None
+        # when the call says nothing of HAPI's health
+        healthy = False
+        try:
+            try:
+                hapi_res = cls.session.request(
+                    method, cls.build_request(path), **kwargs)
+            except requests.Timeout:
+                record_call(
+                    'hapi', method, path, 504, None, time.monotonic() - start)
+                if not configured_timeout:
+                    healthy = None
+                raise GatewayTimeout(f"HAPI {endpoint} timed out")
+            except requests.ConnectionError:
+                record_call(
+                    'hapi', method, path, 503, None, time.monotonic() - start)
+                raise ServiceUnavailable(f"HAPI {endpoint} unreachable")
+
+            nbytes = hapi_res.headers.get('Content-Length')
+            if nbytes is None and not kwargs.get('stream'):
+                nbytes = len(hapi_res.content)
+            record_call(
+                'hapi', method, path, hapi_res.status_code,
+                nbytes and int(nbytes), time.monotonic() - start)
+            healthy = hapi_res.status_code < 500
+        finally:
+            if healthy is None:
+                breaker.record_inconclusive()
+            elif healthy:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        hapi_res.raise_for_status()
+        return hapi_res
+
+    in_flight = SingleFlight()
+
+    @classmethod
+    def find_bundle(cls, resource_type, search_dict, elements=None):
+        """Search for bundled results from given params and return
+
+        Identical searches issued concurrently within the process share
+        a single upstream request, unless ``HAPI_COALESCE`` is disabled.
+
+        :param elements: optional top level elements to request of each
+          resource (via ``_elements``), stripped locally if HAPI doesn't
+        """
+        if elements:
+            search_dict = with_elements(search_dict, elements)
         url = HapiRequest.build_request(resource_type)
         current_app.logger.debug(f"HAPI query: {url} + {search_dict}")
-        hapi_res = requests.get(HapiRequest.build_request(
-            resource_type), headers=ACCEPT_JSON, params=search_dict)
-        hapi_res.raise_for_status()
-        bundle = hapi_res.json()
+        if not current_app.config.get("HAPI_COALESCE"):
+            bundle, status = cls._search(resource_type, search_dict)
+        else:
+            bundle, status = cls.in_flight.do(
+                canonical_search(resource_type, search_dict),
+                cls._search, resource_type, search_dict)
+        if elements:
+            project_bundle(bundle, elements)
+        return bundle, status
+
+    @classmethod
+    def _search(cls, resource_type, search_dict):
+        hapi_res = HapiRequest.request(
+            'GET', resource_type, params=search_dict)
+        bundle = json_body(hapi_res)
         assert bundle.get('resourceType') == 'Bundle'
         return bundle, hapi_res.status_code
 
     @classmethod
-    def find_one(cls, resource_type, search_dict):
+    def iter_pages(
+            cls, resource_type, search_dict, page_size=None, elements=None):
+        """Generator yielding each page (Bundle) of search results
+
+        The first page comes from ``find_bundle``; subsequent pages are
+        requested lazily by following the Bundle's ``next`` link, so only
+        one page is held at a time.
+
+        :param page_size: requested ``_count`` per page, unless included in
+          ``search_dict``.  Defaults to configured ``HAPI_PAGE_SIZE``
+        :param elements: see ``find_bundle``
+        """
+        search_dict = dict(search_dict)
+        if '_count' not in search_dict:
+            search_dict['_count'] = (
+                page_size or current_app.config.get("HAPI_PAGE_SIZE"))
+
+        bundle, status = cls.find_bundle(
+            resource_type, search_dict, elements=elements)
+        while bundle:
+            yield bundle
+            next_url = next_link(bundle)
+            if not next_url:
+                return
+            current_app.logger.debug(f"HAPI next page: {next_url}")
+            bundle = json_body(cls.request('GET', next_url))
+            if elements:
+                project_bundle(bundle, elements)
+
+    @classmethod
+    def iter_resources(
+            cls, resource_type, search_dict, page_size=None, elements=None):
+        """Generator yielding every resource matching the search
+
+        Pages through all results; see ``iter_pages``
+        """
+        for bundle in cls.iter_pages(
+                resource_type, search_dict, page_size, elements):
+            for entry in bundle.get('entry', []):
+                yield entry['resource']
+
+    @classmethod
+    def stream_resources(
+            cls, resource_type, search_dict, elements=None, page_size=None):
+        """Generator yielding every matching resource as it is parsed
+
+        Like ``iter_resources``, but each page is parsed incrementally from
+        the response stream (see ``iter_bundle_entries``), so memory use
+        is bounded by the largest single entry rather than the page size.
+
+        :param elements: optional top level elements to request of each
+          resource, also discarding any others as soon as it's parsed
+        :param page_size: see ``iter_pages``
+        """
+        params = dict(search_dict)
+        if '_count' not in params:
+            params['_count'] = (
+                page_size or current_app.config.get("HAPI_PAGE_SIZE"))
+        if elements:
+            params = with_elements(params, elements)
+
+        url = resource_type
+        while url:
+            current_app.logger.debug(f"HAPI stream: {url} + {params}")
+            fields = {}
+            hapi_res = cls.request('GET', url, params=params, stream=True)
+            with closing(hapi_res):
+                text = codecs.iterdecode(
+                    hapi_res.iter_content(STREAM_CHUNK_SIZE), 'utf-8')
+                for entry in iter_bundle_entries(text, fields):
+                    resource = entry['resource']
+                    if elements and not is_subsetted(resource):
+                        resource = project(resource, elements)
+                    yield resource
+            url, params = next_link(fields), None
+
+    @classmethod
+    def stream(cls, path, params=None):
+        """GET path, returning the response with its body left unread
+
+        For passing HAPI's bytes straight through; the caller must consume
+        or close the response to release the pooled connection.
+        """
+        return cls.request('GET', path, params=params, stream=True)
+
+    @classmethod
+    def find_one(cls, resource_type, search_dict, elements=None):
         """Search for single resource match, return if found
 
         Executes search for given parameters.  If a single
@@ -45,7 +408,8 @@ class HapiRequest(metaclass=HapiMeta):
         return
 
         """
-        bundle, status = HapiRequest.find_bundle(resource_type, search_dict)
+        bundle, status = HapiRequest.find_bundle(
+            resource_type, search_dict, elements=elements)
         if bundle.get('total') != 1:
             current_app.logger.warn(
                 f"unexpected {bundle.get('total')} items in bundle")
@@ -58,32 +422,117 @@ class HapiRequest(metaclass=HapiMeta):
         return cp, status
 
     @classmethod
-    def find_by_id(cls, resource_type, resource_id):
-        """Search for single resource match, return if found"""
-        hapi_res = requests.get(HapiRequest.build_request(
-            f"{resource_type}/{resource_id}"), headers=ACCEPT_JSON)
-        hapi_res.raise_for_status()
-        return hapi_res.json(), hapi_res.status_code
+    def find_by_id(cls, resource_type, resource_id, elements=None):
+        """Search for single resource match, return if found
+
+        Previously read resources are cached along with their ETag, and
+        revalidated via ``If-None-Match``; on a 304 the cached copy is
+        returned without transferring or parsing the body again.
+
+        :param elements: see ``find_bundle``; projected reads aren't cached
+        """
+        key = f"{resource_type}/{resource_id}"
+        if elements:
+            hapi_res = HapiRequest.request(
+                'GET', key, params=with_elements({}, elements))
+            resource = json_body(hapi_res)
+            if not is_subsetted(resource):
+                resource = project(resource, elements)
+            return resource, hapi_res.status_code
+
+        cached = cls.resource_cache.get(key)
+        headers = dict(ACCEPT_JSON)
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        hapi_res = HapiRequest.request('GET', key, headers=headers)
+        if hapi_res.status_code == 304 and cached:
+            return deepcopy(cached[1]), 200
+
+        resource = json_body(hapi_res)
+        etag = hapi_res.headers.get('ETag')
+        version_id = resource.get('meta', {}).get('versionId')
+        if not etag and version_id:
+            etag = f'W/"{version_id}"'
+        if etag:
+            cls.resource_cache.set(key, (etag, deepcopy(resource)))
+        return resource, hapi_res.status_code
 
     @classmethod
     def delete_by_id(cls, resource_type, resource_id):
         """Delete a single resource"""
-        hapi_res = requests.delete(HapiRequest.build_request(
-            f"{resource_type}/{resource_id}"), headers=ACCEPT_JSON)
-        hapi_res.raise_for_status()
-        return hapi_res.json(), hapi_res.status_code
+        cls.resource_cache.pop(f"{resource_type}/{resource_id}")
+        hapi_res = HapiRequest.request(
+            'DELETE', f"{resource_type}/{resource_id}")
+        return json_body(hapi_res), hapi_res.status_code
 
     @classmethod
     def post_resource(cls, resource):
-        url = cls.build_request(f'{resource["resourceType"]}')
-        result = requests.post(url, json=resource, headers=ACCEPT_JSON)
-        result.raise_for_status()
-        return result.json(), result.status_code
+        result = cls.request(
+            'POST', f'{resource["resourceType"]}', json=resource)
+        return json_body(result), result.status_code
 
     @classmethod
     def put_resource(cls, resource):
-        url = cls.build_request(
-            f'{resource["resourceType"]}/{resource["id"]}')
-        result = requests.put(url, json=resource, headers=ACCEPT_JSON)
-        result.raise_for_status()
-        return result.json(), result.status_code
+        cls.resource_cache.pop(f'{resource["resourceType"]}/{resource["id"]}')
+        result = cls.request(
+            'PUT', f'{resource["resourceType"]}/{resource["id"]}',
+            json=resource)
+        return json_body(result), result.status_code
+
+    @classmethod
+    def batch(cls, operations, bundle_type='batch', chunk_size=None):
+        """Execute several operations per round trip via FHIR batch Bundles
+
+        :param operations: sequence of (method, target) tuples, where
+          target is the resource for 'POST' (create) or 'PUT' (update),
+          and the relative url, i.e. "Consent/12", for 'GET' or 'DELETE'
+        :param bundle_type: 'batch' or 'transaction'
+        :param chunk_size: max operations per Bundle, defaults to configured
+          ``HAPI_BATCH_SIZE``.  NB a transaction is only atomic per chunk
+        :returns: list of (resource or OperationOutcome, status) tuples, in
+          the order of ``operations``
+
+        """
+        operations = list(operations)
+        chunk_size = chunk_size or current_app.config.get("HAPI_BATCH_SIZE")
+        results = []
+        for start in range(0, len(operations), chunk_size):
+            entries = [
+                cls.bundle_entry(method, target)
+                for method, target in operations[start:start + chunk_size]]
+            for entry in entries:
+                if entry['request']['method'] in ('PUT', 'DELETE'):
+                    cls.resource_cache.pop(entry['request']['url'])
+
+            current_app.logger.debug(
+                f"HAPI {bundle_type} of {len(entries)} entries")
+            response = json_body(cls.request('POST', '', json={
+                'resourceType': 'Bundle',
+                'type': bundle_type,
+                'entry': entries}))
+            for entry in response.get('entry', []):
+                status = int(entry['response']['status'].split()[0])
+                results.append((
+                    entry.get('resource', entry['response'].get('outcome')),
+                    status))
+        return results
+
+    @classmethod
+    def transaction(cls, operations, chunk_size=None):
+        """Execute operations as FHIR transaction Bundle(s); see ``batch``"""
+        return cls.batch(
+            operations, bundle_type='transaction', chunk_size=chunk_size)
+
+    @staticmethod
+    def bundle_entry(method, target):
+        """Return batch/transaction Bundle entry for the given operation"""
+        if method in ('GET', 'DELETE'):
+            return {'request': {'method': method, 'url': target}}
+        if method == 'POST':
+            url = target['resourceType']
+        elif method == 'PUT':
+            url = f"{target['resourceType']}/{target['id']}"
+        else:
+            raise ValueError(f"unsupported batch method {method}")
+        return {'resource': target, 'request': {'method': method, 'url': url}}
@@ -0,0 +1,52 @@
+"""Field projection of FHIR resources, akin to the ``_elements`` param"""
+
+# Always retained, as FHIR mandates for ``_elements``
+MANDATORY_ELEMENTS = ('resourceType', 'id', 'meta')
+SUBSETTED = {
+    'system': "http://terminology.hl7.org/CodeSystem/v3-ObservationValue",
+    'code': "SUBSETTED"}
+
+
+def project(resource, elements):
+    """Return copy of resource retaining only the named top level elements
+
+    :param resource: FHIR resource (dict)
+    :param elements: iterable of top level element names to retain, in
+      addition to ``MANDATORY_ELEMENTS``
+
+    """
+    keep = set(elements).union(MANDATORY_ELEMENTS)
+    return {k: v for k, v in resource.items() if k in keep}
+
+
+def is_subsetted(resource):
+    """True if resource is tagged as already subsetted by the server"""
+    return any(
+        tag.get('system') == SUBSETTED['system'] and
+        tag.get('code') == SUBSETTED['code']
+        for tag in resource.get('meta', {}).get('tag', []))
+
+
+def project_bundle(bundle, elements, unless_subsetted=True):
+    """Project each Bundle entry's resource, unless server already did
+
+    Local fallback for servers ignoring ``_elements``; modifies bundle in
+    place and returns it.
+
+    :param unless_subsetted: set False to project even those resources
+      the server already subsetted
+    """
+    for entry in bundle.get('entry', []):
+        if 'resource' not in entry:
+            continue
+        if unless_subsetted and is_subsetted(entry['resource']):
+            continue
+        entry['resource'] = project(entry['resource'], elements)
+    return bundle
+
+
+def with_elements(search_dict, elements):
+    """Return copy of search parameters requesting the given elements"""
+    params = search_dict.copy()
+    params['_elements'] = ','.join(elements)
+    return params
@@ -0,0 +1,97 @@
+"""Incremental parsing of (large) FHIR Bundle JSON documents
+
+Bundle entries are decoded one at a time as the document text arrives,
+so only a single entry, rather than the whole Bundle, is held in memory.
+"""
+from json import JSONDecodeError, JSONDecoder
+
+decoder = JSONDecoder()
+WHITESPACE = ' \t\n\r'
+
+
+class _Reader(object):
+    """Buffer over text chunks, discarding text already consumed"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+
+    def more(self):
+        """Append next chunk to buffer; returns False once exhausted"""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return next non whitespace character, without consuming it"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                raise ValueError("unexpected end of JSON document")
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"expected '{char}' in JSON; found '{found}'")
+        self.pos += 1
+
+    def value(self):
+        """Decode and consume the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except JSONDecodeError:
+                # presumably incomplete - retry with more text
+                if not self.more():
+                    raise
+                continue
+            # a number ending the buffer may continue in the next chunk
+            if end == len(self.buf) and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_bundle_entries(chunks, fields=None):
+    """Generator yielding each ``entry`` of a Bundle as it is parsed
+
+    :param chunks: iterable of text chunks forming a Bundle JSON document
+    :param fields: optional dict, populated with the other top level
+      Bundle fields (i.e. ``link`` and ``total``) as they are parsed
+
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key != 'entry':
+            value = reader.value()
+            if fields is not None:
+                fields[key] = value
+        else:
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() != ',':
+                        reader.expect(']')
+                        break
+                    reader.pos += 1
+
+        if reader.peek() != ',':
+            reader.expect('}')
+            return
+        reader.pos += 1
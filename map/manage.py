@@ -1,6 +1,10 @@
 import click
+from flask import current_app
 
 from map.app import create_app
+from map.couch import couch
+from map.couch.bulk import sync_patients
+from map.couch.changes import ChangesConsumer
 from map.migrations import Migration
 
 
@@ -12,3 +16,52 @@ def sync():
     """Load static data idempotently"""
     Migration().upgrade()
     click.echo('sync CLI command complete')
+
+
+@app.cli.command("sync-patients")
+@click.option(
+    '--concurrency', default=4, show_default=True,
+    help="Number of patients synced at once")
+@click.option(
+    '--checkpoint', default='sync-patients.checkpoint', show_default=True,
+    type=click.Path(dir_okay=False),
+    help="File logging progress, replaced unless resuming")
+@click.option(
+    '--resume', is_flag=True,
+    help="Skip patients the checkpoint logs as synced by a prior run")
+@click.option(
+    '--full', is_flag=True,
+    help="Complete sync of each patient, ignoring any watermark")
+def sync_all_patients(concurrency, checkpoint, resume, full):
+    """Sync every HAPI Patient, and related resources, with couch"""
+    stats = sync_patients(
+        current_app._get_current_object(), concurrency=concurrency,
+        checkpoint_path=checkpoint, resume=resume, full=full,
+        progress=click.echo)
+    for patient_id, error in stats.failures:
+        click.echo(f"failed Patient/{patient_id}: {error}", err=True)
+    click.echo(stats.summary())
+
+
+@app.cli.command("follow-couch")
+@click.option(
+    '--state', default='couch-changes.state', show_default=True,
+    type=click.Path(dir_okay=False),
+    help="File persisting the change feeds' sequences")
+@click.option(
+    '--batch-size', default=100, show_default=True,
+    help="Max changes synced to HAPI at once")
+@click.option(
+    '--poll-timeout', default=60, show_default=True,
+    help="Seconds to wait for couch updates per request")
+@click.option(
+    '--from-now', is_flag=True,
+    help="Ignore changes made prior to now, rather than since the state")
+def follow_couch(state, batch_size, poll_timeout, from_now):
+    """Push changes made in patients' couch dbs to HAPI, until interrupted"""
+    consumer = ChangesConsumer(
+        couch, state_path=state, batch_size=batch_size,
+        poll_timeout=poll_timeout)
+    if from_now:
+        consumer.start_from_now()
+    consumer.run(current_app._get_current_object())
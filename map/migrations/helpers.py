@@ -1,5 +1,5 @@
 """Helper functions for migrations in the name of DRY"""
-from map.fhir import Bundle, HapiRequest, ResourceType
+from map.fhir import HapiRequest, ResourceType
 
 
 def add_missing_questionnaire(cp, missing_questionnaire):
@@ -24,11 +24,10 @@ def extend_care_plan(missing_questionnaire):
     careplanTemplateId = 1058
 
     # Obtain all CarePlans based on the template, assigned to a Patient
-    params = {'based-on': careplanTemplateId, '_count': 1000}
-    results, _ = HapiRequest.find_bundle(
-        resource_type=ResourceType.CarePlan.value, search_dict=params)
-    care_plans = Bundle(results)
-    for cp in care_plans.resources():
+    params = {'based-on': careplanTemplateId}
+    updates = []
+    for cp in HapiRequest.iter_resources(
+            resource_type=ResourceType.CarePlan.value, search_dict=params):
         if 'subject' not in cp:
             continue
 
@@ -37,7 +36,11 @@ def extend_care_plan(missing_questionnaire):
             print(
                 "Added missing Questionnaire to CarePlan %s for "
                 "%s" % (cp['id'], str(cp['subject'])))
-            result, status = HapiRequest.put_resource(cp)
-            if status != 200:
-                print(
-                    "Failed with status %d: %s" % (status, result.text))
+            updates.append(('PUT', cp))
+
+    results = HapiRequest.batch(updates)
+    for (result, status), (_, cp) in zip(results, updates):
+        if status != 200:
+            print(
+                "Failed CarePlan %s with status %d: %s" % (
+                    cp['id'], status, result))
@@ -1,5 +1,5 @@
 """Purge obsolete consents and bogus patient accounts"""
-from map.fhir import Bundle, HapiRequest, ResourceType
+from map.fhir import HapiRequest, PagedBundle
 
 version = 8
 
@@ -37,13 +37,23 @@ def upgrade():
     consent_ids_to_delete = []
     for org_id in (1463, 1464, 1465, 1466, 1467, 1737):
         # query for patients with at least one consent on file
-        consented_patients, status = HapiRequest.find_bundle("Consent", search_dict={
+        consented_patients = HapiRequest.iter_pages("Consent", search_dict={
             'organization': '/'.join(("Organization", str(org_id))),
-            '_include': "Consent.patient", '_count': 1000, '_sort': '-period'})
-        assert status == 200
+            '_include': "Consent.patient", '_sort': '-period'})
         consent_ids_to_delete.extend(keep_best_per_tuple(
-            consented_patient_bundle=Bundle(consented_patients)))
+            consented_patient_bundle=PagedBundle(consented_patients)))
 
     print("Purging %d obsolete Consents" % len(consent_ids_to_delete))
-    for con_id in consent_ids_to_delete:
-        HapiRequest.delete_by_id("Consent", con_id)
+    results = HapiRequest.batch(
+        [('DELETE', f"Consent/{con_id}") for con_id in consent_ids_to_delete])
+    failed = []
+    for (result, status), con_id in zip(results, consent_ids_to_delete):
+        if status >= 400:
+            print(
+                "Failed to delete Consent %s with status %d: %s" % (
+                    con_id, status, result))
+            failed.append(con_id)
+    if failed:
+        raise RuntimeError(
+            "Failed to purge %d of %d obsolete Consents" % (
+                len(failed), len(consent_ids_to_delete)))
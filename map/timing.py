@@ -0,0 +1,123 @@
+"""Per request instrumentation of upstream (HAPI, couch) calls and phases
+
+Each API request collects a ``RequestTiming`` in ``flask.g``, to which
+upstream calls and timed phases (i.e. JWT validation) are recorded.  The
+aggregate is returned in the ``Server-Timing`` response header and, if
+``TIMING_LOG`` is configured, logged as a structured summary.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import re
+import time
+
+from flask import current_app, g, has_app_context, request
+
+ID_SEGMENT = re.compile(r'^(?P<type>[A-Z][A-Za-z]+)/[^/]+')
+
+
+def normalise_path(path):
+    """Return path with ids and query replaced, for grouping similar calls
+
+    i.e. "Patient/12/_history/3?x=y" becomes "Patient/{id}/_history/3"
+    """
+    if '_getpages' in path:
+        return '_getpages'
+    path = path.split('?')[0]
+    return ID_SEGMENT.sub(r'\g<type>/{id}', path)
+
+
+class RequestTiming(object):
+    """Collects upstream calls and phase durations for a single request"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.calls = []
+        self.phases = defaultdict(float)
+
+    def record(self, service, method, path, status, nbytes, duration):
+        """Record a single upstream call; duration in seconds"""
+        self.calls.append({
+            'service': service,
+            'method': method,
+            'path': normalise_path(path),
+            'status': status,
+            'bytes': nbytes,
+            'ms': round(duration * 1000, 2)})
+        self.phases[service] += duration
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.monotonic() - start
+
+    def header(self):
+        """Returns ``Server-Timing`` header value"""
+        metrics = []
+        for name, duration in sorted(self.phases.items()):
+            metric = f"{name};dur={duration * 1000:.1f}"
+            calls = sum(1 for c in self.calls if c['service'] == name)
+            if calls:
+                metric += f';desc="{calls} calls"'
+            metrics.append(metric)
+        total = time.monotonic() - self.started
+        metrics.append(f"total;dur={total * 1000:.1f}")
+        return ', '.join(metrics)
+
+    def summary(self):
+        """Returns dict summarising the request, for structured logging"""
+        return {
+            'upstream_calls': len(self.calls),
+            'upstream_ms': round(sum(c['ms'] for c in self.calls), 2),
+            'phases_ms': {
+                k: round(v * 1000, 2) for k, v in self.phases.items()},
+            'total_ms': round((time.monotonic() - self.started) * 1000, 2),
+            'calls': self.calls}
+
+
+def current_timing():
+    """Returns the ``RequestTiming`` in effect, if any"""
+    return g.get('timing') if has_app_context() else None
+
+
+def start_timing():
+    """``before_request`` hook, starting collection for the request"""
+    g.timing = RequestTiming()
+
+
+def record_call(service, method, path, status, nbytes, duration):
+    """Record upstream call on the current request's timing, if any"""
+    timing = current_timing()
+    if timing is not None:
+        timing.record(service, method, path, status, nbytes, duration)
+
+
+@contextmanager
+def timed_phase(name):
+    """Context manager adding time spent within to the named phase"""
+    timing = current_timing()
+    if timing is None:
+        yield
+        return
+    with timing.phase(name):
+        yield
+
+
+def add_server_timing(response):
+    """``after_request`` hook, adding the header and optional log summary"""
+    timing = current_timing()
+    if timing is None:
+        return response
+    if current_app.config.get("SERVER_TIMING"):
+        response.headers['Server-Timing'] = timing.header()
+    if current_app.config.get("TIMING_LOG"):
+        summary = timing.summary()
+        summary.update({
+            'method': request.method,
+            'path': normalise_path(request.path),
+            'status': response.status_code})
+        current_app.logger.info(json.dumps(summary))
+    return response
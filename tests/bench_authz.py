@@ -0,0 +1,95 @@
+"""Microbenchmark of Bundle read checks, at 10, 1k and 10k entries
+
+Compares ``AuthorizedUser.check`` with the former per entry approach, a
+check instance per entry and removal by list of ids.  Run with::
+
+    python -m tests.bench_authz
+
+"""
+from copy import deepcopy
+import timeit
+
+from werkzeug.exceptions import Unauthorized
+
+from map.app import create_app
+from map.authz import AuthorizedUser
+from map.authz.authorizedresource import authz_check_resource
+from map.fhir import Bundle
+from .test_authz import generate_claims
+
+SIZES = (10, 1000, 10000)
+KC_SYSTEM = "https://keycloak-dev.cirg.washington.edu/auth/realms/Stayhome"
+
+
+def patient_bundle(size, sub):
+    """Bundle of Patients, every tenth identified by sub"""
+    return {'resourceType': 'Bundle', 'total': size, 'entry': [{
+        'resource': {
+            'resourceType': 'Patient', 'id': str(i), 'identifier': [{
+                'system': KC_SYSTEM,
+                'value': sub if i % 10 == 0 else f"other-{i}"}]}}
+        for i in range(size)]}
+
+
+def legacy_remove_entries(bundle, ids):
+    """``Bundle.remove_entries`` as it was, searching the list of ids"""
+    count_b4 = len(bundle)
+    keepers = []
+    found_count = 0
+    for i in bundle.bundle['entry']:
+        if i['resource']['id'] not in ids:
+            keepers.append(i)
+        else:
+            found_count += 1
+
+    if found_count != len(ids):
+        raise ValueError(f"unable to remove all {ids}; can't continue")
+
+    if 'total' in bundle.bundle:
+        bundle.bundle['total'] = count_b4 - found_count
+    bundle.bundle['entry'] = keepers
+
+
+def legacy_check(user, fhir):
+    """Bundle read check as done prior to ``authz_filter``"""
+    bundle = Bundle(fhir)
+    remove_ids = []
+    for item in bundle.resources():
+        ar = authz_check_resource(authz_user=user, resource=item)
+        try:
+            ar.read()
+        except Unauthorized:
+            remove_ids.append(item['id'])
+    if remove_ids:
+        legacy_remove_entries(bundle, remove_ids)
+    return bundle.bundle
+
+
+def run(label, check, user, bundle, number):
+    copies = [deepcopy(bundle) for _ in range(number)]
+    elapsed = timeit.timeit(
+        lambda: check(user, copies.pop()), number=number)
+    per_entry = elapsed / number / len(bundle['entry']) * 1e6
+    print(f"{label:>8} {len(bundle['entry']):>6} entries: "
+          f"{elapsed / number * 1e3:9.3f} ms/bundle {per_entry:7.3f} us/entry")
+
+
+def main():
+    app = create_app(testing=True)
+    with app.app_context():
+        for roles in ([], ['admin']):
+            claims = generate_claims(
+                email='f@f', sub='bench-subject', roles=roles)
+            user = AuthorizedUser(claims)
+            user._patient_id, user._org_id = "0", "1465"
+            print(f"roles: {roles or ['patient']}")
+            for size in SIZES:
+                bundle = patient_bundle(size, 'bench-subject')
+                number = max(1, 20000 // size)
+                run('legacy', legacy_check, user, bundle, number)
+                run('filter', lambda u, b: u.check('read', b),
+                    user, bundle, number)
+
+
+if __name__ == '__main__':
+    main()
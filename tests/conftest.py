@@ -4,6 +4,8 @@ import pytest
 from map.models import User
 from map.app import create_app
 from map.extensions import db as _db
+from map.fakes import FakeCouch, FakeHapi
+from map.fhir import HapiRequest
 SECRET = 'testing-secret'
 
 
@@ -77,3 +79,28 @@ def admin_refresh_headers(admin_user, client):
         'content-type': 'application/json',
         'authorization': 'Bearer %s' % tokens['refresh_token']
     }
+
+
+@pytest.fixture
+def fake_hapi(app):
+    """In process HAPI, answering all HapiRequest calls"""
+    fake = FakeHapi(base_url='http://fake-hapi/fhir/')
+    app.config['HAPI_URL'] = fake.base_url
+    HapiRequest._base_url = None
+    with app.app_context():
+        fake.mount(HapiRequest.session)
+        HapiRequest.resource_cache.clear()
+
+    yield fake
+
+    HapiRequest._session.adapters.pop(fake.base_url)
+    HapiRequest._base_url = None
+    HapiRequest._resource_cache = None
+
+
+@pytest.fixture
+def fake_couch(mocker):
+    """In process couch server, in place of ``map.couch.server.couch``"""
+    fake = FakeCouch()
+    mocker.patch('map.couch.patient.couch', fake)
+    return fake
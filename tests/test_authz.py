@@ -5,7 +5,14 @@ import os
 from pytest import fixture
 
 from .conftest import SECRET
-from map.authz.authorizeduser import AuthorizedUser
+from map.authz.authorizeduser import (
+    AuthorizedUser,
+    consent_roster_cache,
+    identity_cache,
+    jwt_payload,
+    token_cache,
+    validate_jwt,
+)
 from map.authz.authorizedresource import authz_check_resource
 from map.fhir import Bundle
 
@@ -103,12 +110,36 @@ def test_patient_noauth(client, mocker, prefix, patient_bundle):
 def test_patient_via_admin(
         admin_jwt, client, mocker, prefix, patient_bundle):
     """with mock admin header, should see all results"""
-    mock_hapi = mocker.patch('map.fhir.HapiRequest.find_bundle')
-    mock_hapi.return_value = patient_bundle, 200
+    mock_hapi = mocker.patch('map.fhir.HapiRequest.stream')
+    mock_hapi.return_value.status_code = 200
+    mock_hapi.return_value.headers = {'Content-Type': 'application/json'}
+    mock_hapi.return_value.iter_content.return_value = [
+        json.dumps(patient_bundle).encode('utf-8')]
 
     results = client.get('/'.join((prefix, 'Patient')), headers={
         'Authorization': 'Bearer {}'.format(admin_jwt)})
     assert results.status_code == 200
+    assert results.json == patient_bundle
+
+
+def test_patient_via_admin_include(
+        admin_jwt, client, mocker, prefix, patient_bundle):
+    """searches able to include other resource types aren't passed through"""
+    mock_hapi = mocker.patch('map.fhir.HapiRequest.find_bundle')
+    mock_hapi.return_value = patient_bundle, 200
+
+    results = client.get(
+        '/'.join((prefix, 'Patient?_revinclude=Consent:patient')),
+        headers={'Authorization': 'Bearer {}'.format(admin_jwt)})
+    assert results.status_code == 200
+    assert mock_hapi.call_count == 1
+
+    # as are those with a modifier
+    results = client.get(
+        '/'.join((prefix, 'Patient?_revinclude:iterate=Consent:patient')),
+        headers={'Authorization': 'Bearer {}'.format(admin_jwt)})
+    assert results.status_code == 200
+    assert mock_hapi.call_count == 2
 
 
 def test_patient_self(client, mocker, prefix, patient_1415, patient_jwt):
@@ -149,14 +180,48 @@ def test_extract_wo_match(client, mocker, no_patient):
     assert test_user._org_id is None
 
 
-def test_consented_patients(mocker, consented_patient_bundle):
+def test_identity_cache(
+        app, client, mocker, prefix, no_patient, patient_1415, patient_jwt):
+    """identity lookups, including misses, are cached until Patient write"""
+    mock_hapi = mocker.patch('map.fhir.HapiRequest.find_bundle')
+    mock_hapi.return_value = no_patient, 200
+
+    mock_payload = generate_claims(
+        email='f@f', sub="6c9d2b3f-a674-4866-9b0c-da0020d36ca7", roles=[])
+    for _ in range(2):
+        test_user = AuthorizedUser(mock_payload)
+        test_user.extract_internals()
+        assert test_user._patient_id is None
+    assert mock_hapi.call_count == 1
+
+    mock_put = mocker.patch('map.fhir.HapiRequest.put_resource')
+    mock_put.return_value = patient_1415, 200
+    results = client.put(
+        '/'.join((prefix, 'Patient/1415')),
+        headers={'Authorization': 'Bearer {}'.format(patient_jwt)},
+        json=patient_1415)
+    assert results.status_code == 200
+    assert len(identity_cache()) == 0
+
+    mock_hapi.return_value = {
+        'resourceType': 'Bundle', 'total': 1,
+        'entry': [{'resource': patient_1415}]}, 200
+    for _ in range(2):
+        test_user = AuthorizedUser(mock_payload)
+        test_user.extract_internals()
+        assert (test_user._patient_id, test_user._org_id) == ("1415", "1465")
+    assert mock_hapi.call_count == 2
+
+
+def test_consented_patients(app, mocker, consented_patient_bundle):
     """test loading consented patients within AuthorizedUser"""
 
-    # mock results looking for consented patients
+    # mock (streamed) results looking for consented patients
+    body = json.dumps(consented_patient_bundle).encode('utf-8')
     mock_consented_patient_bundle = mocker.patch(
-        'map.fhir.HapiRequest.find_bundle')
-    mock_consented_patient_bundle.return_value = (
-        consented_patient_bundle, 200)
+        'map.fhir.HapiRequest.request')
+    mock_consented_patient_bundle.return_value.iter_content.return_value = (
+        body[i:i + 100] for i in range(0, len(body), 100))
 
     mock_payload = generate_claims(
         email='f@f', sub="6c9d2b3f-a674-4866-9b0c-da0020d36ca7", roles=[])
@@ -166,6 +231,36 @@ def test_consented_patients(mocker, consented_patient_bundle):
     assert "1791" in results
 
 
+def test_consented_patients_shared(
+        admin_jwt, app, client, mocker, prefix, consented_patient_bundle):
+    """rosters are shared across users until a Consent is written"""
+    mock_stream = mocker.patch('map.fhir.HapiRequest.stream_resources')
+    mock_stream.side_effect = lambda *args, **kwargs: iter(
+        Bundle(consented_patient_bundle).resources())
+
+    mock_payload = generate_claims(
+        email='f@f', sub="6c9d2b3f-a674-4866-9b0c-da0020d36ca7", roles=[])
+    first = AuthorizedUser(mock_payload).consented_users(org_id=1465)
+    second = AuthorizedUser(mock_payload).consented_users(org_id=1465)
+    assert first == second
+    assert mock_stream.call_count == 1
+    search = mock_stream.call_args[1]['search_dict']
+    assert '_include' not in search
+    assert search['status'] == 'active'
+
+    mock_post = mocker.patch('map.fhir.HapiRequest.post_resource')
+    mock_post.return_value = {}, 201
+    results = client.post(
+        '/'.join((prefix, 'Consent')),
+        headers={'Authorization': 'Bearer {}'.format(admin_jwt)},
+        json={'resourceType': 'Consent', 'status': 'active'})
+    assert results.status_code == 201
+    assert len(consent_roster_cache()) == 0
+
+    AuthorizedUser(mock_payload).consented_users(org_id=1465)
+    assert mock_stream.call_count == 2
+
+
 def test_consented_patients_wo_config(app, mocker, consented_patient_bundle):
     """with SAME_ORG_CHECK=False all patients should pass authorization check"""
     app.config['SAME_ORG_CHECK'] = False
@@ -203,6 +298,49 @@ def test_consented_patients_query(
     assert len(results.json['entry']) == 1
     assert results.json['entry'][0]['resource']['id'] == "41"
 
+    # expect HAPI search narrowed to patients consented with user's org
+    search = mock_patient_bundle.call_args[0][1]
+    assert search['_has:Consent:patient:organization'] == (
+        "Organization/1465")
+
+
+def test_patient_search_scope(
+        client, mocker, prefix, patient_1415, patient_jwt):
+    """patient searches are narrowed to the user's own identifier"""
+    bundle = {'resourceType': 'Bundle', 'entry': [{'resource': patient_1415}]}
+    mock_hapi = mocker.patch('map.fhir.HapiRequest.find_bundle')
+    mock_hapi.return_value = bundle, 200
+
+    results = client.get(
+        '/'.join((prefix, 'Patient?identifier=phone|555')),
+        headers={'Authorization': 'Bearer {}'.format(patient_jwt)})
+    assert results.status_code == 200
+    search = mock_hapi.call_args_list[0][0][1]
+    assert search['identifier'] == [
+        'phone|555',
+        'https://keycloak-dev.cirg.washington.edu/auth/realms/Stayhome|'
+        '6c9d2b3f-a674-4866-9b0c-da0020d36ca7']
+
+
+def test_org_staff_search_scope_keeps_own(
+        org_staff_jwt, client, mocker, prefix, patient_1415):
+    """org_staff find their own Patient, even without a Consent on it"""
+    bundle = {'resourceType': 'Bundle', 'entry': [{'resource': patient_1415}]}
+    mock_hapi = mocker.patch('map.fhir.HapiRequest.find_bundle')
+    mock_hapi.return_value = bundle, 200
+    mock_patient = mocker.patch('map.fhir.HapiRequest.find_one')
+    mock_patient.return_value = patient_1415, 200
+    mock_consented = mocker.patch(
+        "map.authz.authorizeduser.AuthorizedUser.consented_users")
+    mock_consented.return_value = {'41'}
+
+    results = client.get('/'.join((prefix, 'Patient')), headers={
+        'Authorization': 'Bearer {}'.format(org_staff_jwt)})
+    assert results.status_code == 200
+    assert [e['resource']['id'] for e in results.json['entry']] == ['1415']
+    search = mock_hapi.call_args[0][1]
+    assert '_has:Consent:patient:organization' not in search
+
 
 def test_qr_post(
         client, mocker, patient_1415, patient_jwt, prefix, qr_post_data):
@@ -220,3 +358,34 @@ def test_qr_post(
         headers={'Authorization': 'Bearer {}'.format(patient_jwt)},
         json=qr_post_data)
     assert results.status_code == 200
+
+
+def test_patient_elements(
+        client, mocker, prefix, patient_1415, patient_jwt):
+    """client projection keeps elements the read check depends on"""
+    bundle = {'resourceType': 'Bundle', 'entry': [{'resource': patient_1415}]}
+    mock_hapi = mocker.patch('map.fhir.HapiRequest.find_bundle')
+    mock_hapi.return_value = bundle, 200
+    mock_patient = mocker.patch('map.fhir.HapiRequest.find_one')
+    mock_patient.return_value = patient_1415, 200
+
+    results = client.get(
+        '/'.join((prefix, 'Patient?_elements=gender')),
+        headers={'Authorization': 'Bearer {}'.format(patient_jwt)})
+    assert results.status_code == 200
+    search = mock_hapi.call_args[0][1]
+    assert 'identifier' in search['_elements'].split(',')
+    assert set(results.json['entry'][0]['resource']) <= {
+        'resourceType', 'id', 'meta', 'gender'}
+
+
+def test_token_cache(app, mocker, patient_jwt):
+    spy = mocker.patch(
+        'map.authz.authorizeduser.validate_jwt', side_effect=validate_jwt)
+    with app.app_context():
+        first = jwt_payload(patient_jwt)
+        second = jwt_payload(patient_jwt)
+        cache = token_cache()
+    assert first == second
+    assert spy.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
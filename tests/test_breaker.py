@@ -0,0 +1,44 @@
+from map.commons.breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+
+
+class FakeClock(object):
+    now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_cycle():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=5, clock=clock)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    clock.now = 5
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # only a single trial while half open
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    clock.now = 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_inconclusive_trial_released():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5, clock=clock)
+    breaker.record_failure()
+    clock.now = 5
+    assert breaker.allow()
+    breaker.record_inconclusive()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
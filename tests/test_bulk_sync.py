@@ -0,0 +1,48 @@
+from map.couch.bulk import sync_patients
+from map.fakes import populate
+
+
+def test_sync_patients(app, fake_hapi, fake_couch, mocker, tmp_path):
+    ids = populate(fake_hapi, patients=6, careplans=6)
+    checkpoint = str(tmp_path / 'sync.checkpoint')
+
+    sync = mocker.patch(
+        'map.couch.bulk.CouchPatientDB.sync', autospec=True)
+    failing = ids['Patient'][2]
+
+    def flaky_sync(patient, full=False):
+        if patient.patient_fhir['id'] == failing:
+            raise RuntimeError("couch unavailable")
+        patient.written.add('CarePlan/54')
+
+    sync.side_effect = flaky_sync
+    with app.app_context():
+        stats = sync_patients(app, concurrency=3, checkpoint_path=checkpoint)
+    assert stats.patients == 5
+    assert stats.documents == 5
+    assert [patient_id for patient_id, _ in stats.failures] == [failing]
+
+    # resumed run skips those synced, retrying the failure
+    sync.side_effect = None
+    sync.reset_mock()
+    with app.app_context():
+        stats = sync_patients(
+            app, concurrency=3, checkpoint_path=checkpoint, resume=True)
+    assert (stats.patients, stats.skipped, stats.failures) == (1, 5, [])
+    assert sync.call_args[0][0].patient_fhir['id'] == failing
+
+    # unless resuming, a run starts afresh
+    with app.app_context():
+        stats = sync_patients(app, concurrency=3, checkpoint_path=checkpoint)
+    assert (stats.patients, stats.skipped) == (6, 0)
+    with open(checkpoint) as log:
+        assert len(log.readlines()) == 6
+
+
+def test_sync_patients_couch(app, fake_hapi, fake_couch):
+    populate(fake_hapi, patients=4, careplans=4)
+    with app.app_context():
+        stats = sync_patients(app, concurrency=2)
+    assert (stats.patients, stats.failures) == (4, [])
+    assert len(fake_couch.databases) == 4
+    assert stats.documents > 4
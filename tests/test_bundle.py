@@ -1,7 +1,7 @@
 import json
 import os
 from pytest import fixture, raises
-from map.fhir import Bundle
+from map.fhir import Bundle, PagedBundle
 
 
 @fixture
@@ -48,3 +48,19 @@ def test_remove(sample_bundle):
     for i in sample_bundle.resources():
         assert i['id'] != "155"
 
+
+def test_filter_entries(sample_bundle):
+    b4 = len(sample_bundle)
+    removed = sample_bundle.filter_entries(lambda r: r['id'] != "155")
+    assert removed == 1
+    assert len(sample_bundle) == b4 - 1
+    assert "155" not in [i['id'] for i in sample_bundle.resources()]
+
+
+def test_paged_bundle(sample_bundle):
+    first, second = dict(sample_bundle.bundle), dict(sample_bundle.bundle)
+    first['entry'], second['entry'] = first['entry'][:3], first['entry'][3:]
+    paged = PagedBundle(iter((first, second)))
+    assert len(paged) == 4
+    assert [r['id'] for r in paged.resources()] == [
+        r['id'] for r in sample_bundle.resources()]
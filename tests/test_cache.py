@@ -0,0 +1,35 @@
+from map.commons.cache import TTLCache
+
+
+class FakeClock(object):
+    now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = TTLCache(max_size=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+
+
+def test_expiry():
+    clock = FakeClock()
+    cache = TTLCache(max_size=2, ttl=10, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+    clock.now = 10
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_disabled():
+    cache = TTLCache(max_size=0, ttl=10)
+    cache.set('a', 1)
+    assert cache.get('a') is None
@@ -0,0 +1,66 @@
+import gzip
+import json
+
+from flask import Response
+
+from map.api.compression import compress_response
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+
+def json_response(data, stream=False):
+    text = json.dumps(data)
+    body = text
+    if stream:
+        body = (text[i:i + 10] for i in range(0, len(text), 10))
+    return Response(body, content_type='application/json')
+
+
+def test_small_uncompressed(app):
+    with app.test_request_context(headers=GZIP):
+        response = compress_response(json_response({'id': '1'}))
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_large_gzip(app):
+    data = {'entry': [{'id': str(i)} for i in range(1000)]}
+    with app.test_request_context(headers=GZIP):
+        response = compress_response(json_response(data))
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.get_data())) == data
+
+
+def test_not_accepted(app):
+    data = {'entry': [{'id': str(i)} for i in range(1000)]}
+    with app.test_request_context(headers={'Accept-Encoding': 'identity'}):
+        response = compress_response(json_response(data))
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_streamed_gzip(app):
+    data = {'entry': [{'id': str(i)} for i in range(10)]}
+    with app.test_request_context(headers=GZIP):
+        response = compress_response(json_response(data, stream=True))
+        assert response.headers['Content-Encoding'] == 'gzip'
+        body = b''.join(response.response)
+    assert json.loads(gzip.decompress(body)) == data
+
+
+def test_already_encoded_varies(app):
+    with app.test_request_context(headers=GZIP):
+        response = json_response({'id': '1'})
+        response.headers['Content-Encoding'] = 'gzip'
+        response = compress_response(response)
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_gzip_level_capped(app):
+    app.config['COMPRESS_LEVEL'] = 11
+    data = {'entry': [{'id': str(i)} for i in range(1000)]}
+    with app.test_request_context(headers=GZIP):
+        response = compress_response(json_response(data))
+        streamed = compress_response(json_response(data, stream=True))
+        body = b''.join(streamed.response)
+    assert json.loads(gzip.decompress(response.get_data())) == data
+    assert json.loads(gzip.decompress(body)) == data
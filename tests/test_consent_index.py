@@ -0,0 +1,110 @@
+from threading import Event
+
+from map.authz import AuthorizedUser
+from map.authz.authorizeduser import resource_written
+from map.authz.consent_index import ConsentIndex, consent_index
+from map.fakes import populate
+from map.fhir import HapiRequest
+from .test_authz import generate_claims
+
+
+def test_consent_index(app, fake_hapi, tmp_path):
+    app.config['CONSENT_INDEX_PATH'] = str(tmp_path / 'consents.db')
+    ids = populate(fake_hapi, patients=6, consents=6, organizations=2)
+    org_id = ids['Organization'][0]
+
+    with app.app_context():
+        # loaded from a background thread, rather than the request
+        consent_index()
+        index = app.extensions['consent_index']
+        try:
+            assert index.loaded.wait(5)
+            assert consent_index() is index
+            expected = set(ids['Patient'][::2])
+            assert index.patients(org_id) == expected
+            assert index.patients(org_id, provision_type='deny') == set()
+
+            # updates since the watermark are picked up by refresh
+            consent = fake_hapi.get('Consent', ids['Consent'][0])
+            consent['status'] = 'inactive'
+            fake_hapi.store(consent)
+            assert index.refresh() >= 1
+            patient_id = consent['patient']['reference'].split('/')[1]
+            assert index.patients(org_id) == expected - {patient_id}
+
+            # authz consults the index, not HAPI
+            count = fake_hapi.request_count
+            user = AuthorizedUser(generate_claims(
+                email='f@f', sub='org-staff', roles=['org_staff']))
+            assert user.consented_users(org_id) == expected - {patient_id}
+            assert fake_hapi.request_count == count
+        finally:
+            index.stop()
+
+
+def test_consent_written_wakes_index(app, fake_hapi, tmp_path, mocker):
+    app.config['CONSENT_INDEX_PATH'] = str(tmp_path / 'consents.db')
+    ids = populate(fake_hapi, patients=2, consents=2, organizations=1)
+
+    with app.app_context():
+        consent_index()
+        index = app.extensions['consent_index']
+        try:
+            assert index.loaded.wait(5)
+            refreshed = Event()
+
+            def failing():
+                refreshed.set()
+                raise RuntimeError('HAPI went away')
+
+            mocker.patch.object(index, 'refresh', failing)
+            # refreshed by the polling thread, well before its next poll;
+            # the failure doesn't reach the writer
+            resource_written(fake_hapi.get('Consent', ids['Consent'][0]))
+            assert refreshed.wait(5)
+        finally:
+            index.stop()
+
+
+def test_consent_index_deletes(app, fake_hapi, tmp_path):
+    ids = populate(fake_hapi, patients=4, consents=4, organizations=1)
+    org_id = ids['Organization'][0]
+    # lacking an organization reference; not indexed
+    fake_hapi.store({
+        'resourceType': 'Consent', 'status': 'active',
+        'patient': {'reference': f"Patient/{ids['Patient'][1]}"},
+        'organization': [{'display': 'unreferenced'}],
+        'provision': {'type': 'permit'}})
+
+    index = ConsentIndex(str(tmp_path / 'consents.db'))
+    assert not index.loaded.is_set()
+    with app.app_context():
+        index.refresh()
+        assert index.loaded.is_set()
+        assert index.patients(org_id) == set(ids['Patient'])
+
+        deleted = fake_hapi.get('Consent', ids['Consent'][0])
+        HapiRequest.delete_by_id('Consent', deleted['id'])
+        index.refresh()
+    patient_id = deleted['patient']['reference'].split('/')[1]
+    assert index.patients(org_id) == set(ids['Patient']) - {patient_id}
+
+
+def test_consent_index_interrupted(app, fake_hapi, tmp_path, mocker):
+    populate(fake_hapi, patients=4, consents=4, organizations=1)
+    index = ConsentIndex(str(tmp_path / 'consents.db'))
+
+    def interrupted(*args, **kwargs):
+        yield from list(fake_hapi.resources['Consent'].values())[:2]
+        raise RuntimeError('HAPI went away')
+
+    app.config['HAPI_PAGE_SIZE'] = 1
+    with app.app_context():
+        mocker.patch.object(HapiRequest, 'iter_resources', interrupted)
+        try:
+            index.refresh()
+        except RuntimeError:
+            pass
+    # a partial load is neither usable nor watermarked
+    assert not index.loaded.is_set()
+    assert index.watermark is None
@@ -0,0 +1,109 @@
+from map.couch import CouchPatientDB
+from map.couch.changes import ChangesConsumer
+from map.fakes import populate
+from map.fakes.hapi import operation_outcome
+from map.fhir import HapiRequest
+
+
+def test_changes_consumer(app, fake_hapi, fake_couch, mocker, tmp_path):
+    ids = populate(fake_hapi, patients=1, careplans=1)
+    state = str(tmp_path / 'changes.state')
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', ids['Patient'][0])
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync()
+        db = fake_couch[patient.userdbname]
+
+        # documents as synced from HAPI aren't pushed back
+        consumer = ChangesConsumer(
+            fake_couch, state, batch_size=3, poll_timeout=0)
+        versions = {
+            key: dict(resources) for key, resources in
+            fake_hapi.resources.items()}
+        consumer.run_once()
+        assert fake_hapi.resources == versions
+
+        # changes made on device are
+        qr_key = f"QuestionnaireResponse/{ids['QuestionnaireResponse'][0]}"
+        qr = dict(db.docs[qr_key], status='amended')
+        qr['meta'] = dict(qr['meta'], lastUpdated='2999-01-01T00:00:00+00:00')
+        db.put(qr_key, qr)
+        db.put('QuestionnaireResponse/device-1', {
+            'resourceType': 'QuestionnaireResponse', 'id': 'device-1',
+            'status': 'completed',
+            'subject': {'reference': f"Patient/{patient_fhir['id']}"}})
+
+        # a failed batch is retried, from the same sequence
+        batch = HapiRequest.batch
+        failures = [RuntimeError("HAPI unavailable")]
+
+        def flaky_batch(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return batch(*args, **kwargs)
+
+        mocker.patch(
+            'map.couch.changes.HapiRequest.batch', side_effect=flaky_batch)
+        consumer.run_once()
+        assert consumer.retry_dbs == {patient.userdbname}
+        assert consumer.backoff() == consumer.retry_delay
+
+        # as is one HAPI fails to update, rather than just logged
+        seq = consumer.state['dbs'][patient.userdbname]
+        handle = fake_hapi.handle
+        put_failures = [operation_outcome(503, "unavailable")]
+
+        def failing_put(method, path, *args, **kwargs):
+            if method == 'PUT' and path == qr_key and put_failures:
+                return put_failures.pop()
+            return handle(method, path, *args, **kwargs)
+
+        mocker.patch.object(fake_hapi, 'handle', side_effect=failing_put)
+        consumer.run_once()
+        assert consumer.retry_dbs == {patient.userdbname}
+        assert consumer.state['dbs'][patient.userdbname] == seq
+
+        # resumed from persisted state
+        consumer = ChangesConsumer(
+            fake_couch, state, batch_size=3, poll_timeout=0)
+        assert consumer.run_once() == 2
+        assert consumer.retry_dbs == set()
+
+    assert fake_hapi.get(
+        'QuestionnaireResponse', qr['id'])['status'] == 'amended'
+    assert fake_hapi.get(
+        'QuestionnaireResponse', 'device-1')['status'] == 'completed'
+
+
+def test_changes_consumer_foreign_patient(app, fake_hapi, fake_couch, tmp_path):
+    ids = populate(fake_hapi, patients=2, careplans=2)
+    patient_id, other_id = ids['Patient']
+    state = str(tmp_path / 'changes.state')
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', patient_id)
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync()
+        db = fake_couch[patient.userdbname]
+        consumer = ChangesConsumer(fake_couch, state, poll_timeout=0)
+        consumer.run_once()
+
+        # documents of another patient, forged on this patient's device
+        other = fake_hapi.get('Patient', other_id)
+        newer = {'lastUpdated': '2999-01-01T00:00:00+00:00'}
+        db.put(f"Patient/{other_id}", dict(other, active=False, meta=newer))
+        qr = next(
+            r for r in fake_hapi.resources['QuestionnaireResponse'].values()
+            if r['subject']['reference'] == f"Patient/{other_id}")
+        db.put(f"QuestionnaireResponse/{qr['id']}", dict(
+            qr, status='amended', meta=newer,
+            subject={'reference': f"Patient/{patient_id}"}))
+        db.put('QuestionnaireResponse/device-2', {
+            'resourceType': 'QuestionnaireResponse', 'id': 'device-2',
+            'status': 'completed',
+            'subject': {'reference': f"Patient/{other_id}"}})
+        consumer.run_once()
+        assert consumer.retry_dbs == set()
+
+    assert fake_hapi.get('Patient', other_id) == other
+    assert fake_hapi.get('QuestionnaireResponse', qr['id']) == qr
+    assert 'device-2' not in fake_hapi.resources['QuestionnaireResponse']
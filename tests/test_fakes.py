@@ -0,0 +1,74 @@
+from pytest import raises
+
+from map.couch import CouchPatientDB
+from map.fakes import populate
+from map.fhir import HapiRequest
+
+
+def test_paging(app, fake_hapi):
+    populate(fake_hapi, patients=25)
+    with app.app_context():
+        patients = list(HapiRequest.iter_resources(
+            'Patient', {}, page_size=10))
+    assert len(patients) == 25
+    assert fake_hapi.request_count == 3
+
+
+def test_include(app, fake_hapi):
+    ids = populate(fake_hapi, patients=4, consents=8, organizations=2)
+    with app.app_context():
+        bundle, status = HapiRequest.find_bundle('Consent', {
+            'organization': f"Organization/{ids['Organization'][0]}",
+            '_include': 'Consent.patient'})
+    modes = [e['search']['mode'] for e in bundle['entry']]
+    assert bundle['total'] == modes.count('match') == 4
+    assert modes.count('include') == 2
+
+
+def test_etag_revalidation(app, fake_hapi):
+    ids = populate(fake_hapi, questionnaires=1)
+    with app.app_context():
+        first, _ = HapiRequest.find_by_id(
+            'Questionnaire', ids['Questionnaire'][0])
+        second, status = HapiRequest.find_by_id(
+            'Questionnaire', ids['Questionnaire'][0])
+    assert (second, status) == (first, 200)
+
+
+def test_batch(app, fake_hapi):
+    ids = populate(fake_hapi, patients=1, consents=3)
+    with app.app_context():
+        results = HapiRequest.batch(
+            [('DELETE', f"Consent/{c}") for c in ids['Consent']] +
+            [('GET', 'Consent/999')])
+    assert [status for _, status in results] == [200, 200, 200, 404]
+    assert fake_hapi.resources['Consent'] == {}
+
+
+def test_patient_sync(app, fake_hapi, fake_couch):
+    ids = populate(
+        fake_hapi, patients=2, careplans=4, questionnaires=3,
+        resources_per_careplan=2)
+    patient_id = ids['Patient'][0]
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', patient_id)
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync()
+
+    db = fake_couch[patient.userdbname]
+    # default + 2 CarePlans, 3 Questionnaires, 4 Procedures, 4 QRs, Patient
+    assert len(db) == 3 + 3 + 4 + 4 + 1
+    assert not any(id.startswith('_design/') for id in db.docs)
+    assert f"Patient/{patient_id}" in db
+
+
+def test_couch_unsupported_options(fake_couch):
+    db = fake_couch.create('userdb-options')
+    db['Patient/1'] = {'resourceType': 'Patient', 'id': '1'}
+    assert [row.id for row in db.view('_all_docs')] == ['Patient/1']
+    with raises(ValueError, match='descending'):
+        db.view('_all_docs', descending=True)
+    with raises(ValueError, match='style'):
+        db.changes(style='all_docs')
+    with raises(ValueError, match='continuous'):
+        fake_couch.db_updates(feed='continuous')
@@ -0,0 +1,222 @@
+import asyncio
+
+from pytest import raises
+import requests
+from urllib3.exceptions import ReadTimeoutError
+from werkzeug.exceptions import GatewayTimeout, ServiceUnavailable
+
+from map.fhir import AsyncHapiRequest, HapiRequest
+from map.fhir.hapi import DeadlineRetry, start_deadline
+
+
+def test_session_reused(app):
+    with app.app_context():
+        assert HapiRequest.session is HapiRequest.session
+
+
+def test_session_per_process(app, mocker):
+    with app.app_context():
+        first = HapiRequest.session
+        mocker.patch('map.fhir.hapi.os.getpid', return_value=-1)
+        assert HapiRequest.session is not first
+
+
+def test_request_timeout(app, mocker):
+    app.config['HAPI_URL'] = 'http://fake-hapi/'
+    HapiRequest._base_url = None
+    with app.app_context():
+        mock_request = mocker.patch.object(HapiRequest.session, 'request')
+        mock_request.return_value.status_code = 200
+        HapiRequest.find_by_id('Questionnaire', 12)
+        HapiRequest.resource_cache.clear()
+    HapiRequest._base_url = None
+
+    args, kwargs = mock_request.call_args
+    assert args == ('GET', 'http://fake-hapi/Questionnaire/12')
+    assert kwargs['timeout'] == (
+        app.config['HAPI_CONNECT_TIMEOUT'], app.config['HAPI_READ_TIMEOUT'])
+
+
+def test_iter_resources_follows_next(app, mocker):
+    pages = [
+        {'resourceType': 'Bundle', 'entry': [{'resource': {'id': '1'}}],
+         'link': [{'relation': 'next', 'url': 'http://fake-hapi/?page=2'}]},
+        {'resourceType': 'Bundle', 'entry': [{'resource': {'id': '2'}}],
+         'link': [{'relation': 'self', 'url': 'http://fake-hapi/?page=2'}]},
+    ]
+    mock_find = mocker.patch(
+        'map.fhir.HapiRequest.find_bundle', return_value=(pages[0], 200))
+    mock_request = mocker.patch('map.fhir.HapiRequest.request')
+    mock_request.return_value.json.return_value = pages[1]
+
+    with app.app_context():
+        found = HapiRequest.iter_resources('Consent', {'a': 'b'}, page_size=1)
+        assert [r['id'] for r in found] == ['1', '2']
+
+    mock_find.assert_called_once_with(
+        'Consent', {'a': 'b', '_count': 1}, elements=None)
+    mock_request.assert_called_once_with('GET', 'http://fake-hapi/?page=2')
+
+
+def test_find_by_id_revalidates(app, mocker):
+    questionnaire = {
+        'resourceType': 'Questionnaire', 'id': '7', 'meta': {'versionId': '3'}}
+    mock_request = mocker.patch('map.fhir.HapiRequest.request')
+    mock_request.return_value.status_code = 200
+    mock_request.return_value.headers = {}
+    mock_request.return_value.json.return_value = questionnaire
+
+    with app.app_context():
+        HapiRequest.resource_cache.clear()
+        assert HapiRequest.find_by_id('Questionnaire', 7) == (
+            questionnaire, 200)
+
+        mock_request.return_value.status_code = 304
+        mock_request.return_value.json.side_effect = ValueError
+        result, status = HapiRequest.find_by_id('Questionnaire', 7)
+        HapiRequest.resource_cache.clear()
+
+    assert (result, status) == (questionnaire, 200)
+    assert result is not questionnaire
+    args, kwargs = mock_request.call_args
+    assert kwargs['headers']['If-None-Match'] == 'W/"3"'
+
+
+def test_batch_chunks(app, mocker):
+    def respond(method, path, json):
+        response = mocker.Mock()
+        response.json.return_value = {
+            'resourceType': 'Bundle', 'type': f"{json['type']}-response",
+            'entry': [{'response': {'status': '204 No Content'}}
+                      for _ in json['entry']]}
+        return response
+
+    mock_request = mocker.patch(
+        'map.fhir.HapiRequest.request', side_effect=respond)
+    operations = [('DELETE', f"Consent/{i}") for i in range(5)]
+    with app.app_context():
+        results = HapiRequest.transaction(operations, chunk_size=2)
+
+    assert results == [(None, 204)] * 5
+    assert mock_request.call_count == 3
+    bundle = mock_request.call_args_list[0][1]['json']
+    assert bundle['type'] == 'transaction'
+    assert bundle['entry'][1] == {
+        'request': {'method': 'DELETE', 'url': 'Consent/1'}}
+
+
+def test_bundle_entry():
+    careplan = {'resourceType': 'CarePlan', 'id': '12'}
+    assert HapiRequest.bundle_entry('PUT', careplan)['request'] == {
+        'method': 'PUT', 'url': 'CarePlan/12'}
+    assert HapiRequest.bundle_entry('POST', careplan)['request'] == {
+        'method': 'POST', 'url': 'CarePlan'}
+
+
+def test_deadline_caps_timeout(app, mocker):
+    with app.app_context():
+        start_deadline(budget=1)
+        connect, read = HapiRequest.timeout()
+        assert connect <= 1 and read <= 1
+
+        mocker.patch('map.fhir.hapi.time.monotonic', return_value=10 ** 9)
+        with raises(GatewayTimeout):
+            HapiRequest.timeout()
+
+
+def test_open_circuit_fails_fast(app, mocker):
+    app.config['HAPI_URL'] = 'http://fake-hapi/'
+    HapiRequest._base_url = None
+    with app.app_context():
+        mock_request = mocker.patch.object(
+            HapiRequest.session, 'request', side_effect=requests.Timeout)
+        breaker = HapiRequest.circuit_breaker('Observation')
+        for _ in range(breaker.failure_threshold):
+            with raises(GatewayTimeout):
+                HapiRequest.find_by_id('Observation', 1)
+        assert breaker.state == 'open'
+
+        with raises(ServiceUnavailable):
+            HapiRequest.find_by_id('Observation', 1)
+        HapiRequest._breakers.clear()
+    HapiRequest._base_url = None
+    assert mock_request.call_count == breaker.failure_threshold
+
+
+def test_deadline_stops_timeout_retries(app):
+    retry = DeadlineRetry(total=3)
+    error = ReadTimeoutError(None, '/Patient', 'timed out')
+    with app.app_context():
+        assert retry.increment('GET', '/Patient', error=error).total == 2
+
+        start_deadline(budget=5)
+        with raises(ReadTimeoutError):
+            retry.increment('GET', '/Patient', error=error)
+
+
+def test_deadline_timeout_not_a_failure(app, mocker):
+    app.config['HAPI_URL'] = 'http://fake-hapi/'
+    HapiRequest._base_url = None
+    with app.app_context():
+        mocker.patch.object(
+            HapiRequest.session, 'request', side_effect=requests.Timeout)
+        breaker = HapiRequest.circuit_breaker('Observation')
+        start_deadline(budget=0.1)
+        for _ in range(breaker.failure_threshold):
+            with raises(GatewayTimeout):
+                HapiRequest.find_by_id('Observation', 1)
+        assert breaker.state == 'closed'
+        assert breaker.failures == 0
+        HapiRequest._breakers.clear()
+    HapiRequest._base_url = None
+
+
+def test_half_open_trial_always_recorded(app, mocker):
+    app.config['HAPI_URL'] = 'http://fake-hapi/'
+    HapiRequest._base_url = None
+    with app.app_context():
+        mocker.patch.object(
+            HapiRequest.session, 'request', side_effect=ValueError)
+        breaker = HapiRequest.circuit_breaker('Observation')
+        breaker.state = 'open'
+        breaker.opened_at = breaker.clock() - breaker.reset_timeout
+        with raises(ValueError):
+            HapiRequest.find_by_id('Observation', 1)
+        assert breaker.state == 'open'
+        assert not breaker._trial_in_flight
+        HapiRequest._breakers.clear()
+    HapiRequest._base_url = None
+
+
+def test_find_bundle_projection_fallback(app, mocker):
+    bundle = {'resourceType': 'Bundle', 'entry': [{'resource': {
+        'resourceType': 'Patient', 'id': '1', 'name': [{'family': 'X'}],
+        'managingOrganization': {'reference': 'Organization/2'}}}]}
+    mock_search = mocker.patch(
+        'map.fhir.HapiRequest._search', return_value=(bundle, 200))
+    mocker.patch('map.fhir.HapiRequest.build_request')
+
+    with app.app_context():
+        result, status = HapiRequest.find_bundle(
+            'Patient', {'identifier': 'a|b'},
+            elements=('managingOrganization',))
+
+    mock_search.assert_called_once_with('Patient', {
+        'identifier': 'a|b', '_elements': 'managingOrganization'})
+    assert result['entry'][0]['resource'] == {
+        'resourceType': 'Patient', 'id': '1',
+        'managingOrganization': {'reference': 'Organization/2'}}
+
+
+def test_async_elements(app, mocker):
+    mock_find = mocker.patch(
+        'map.fhir.HapiRequest.find_by_id', return_value=({}, 200))
+
+    async def find():
+        return await AsyncHapiRequest().find_by_id(
+            'Patient', 12, elements=('identifier',))
+
+    with app.app_context():
+        asyncio.run(find())
+    mock_find.assert_called_once_with(
+        'Patient', 12, elements=('identifier',))
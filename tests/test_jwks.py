@@ -0,0 +1,66 @@
+import base64
+import json
+
+from jose import jwt
+from jose.exceptions import JWTError
+from pytest import fixture, raises
+
+from map.authz.jwks import KeyRegistry, parse_jwks
+
+
+def oct_jwk(kid, secret):
+    k = base64.urlsafe_b64encode(secret).rstrip(b'=').decode('ascii')
+    return {'kty': 'oct', 'kid': kid, 'alg': 'HS256', 'k': k}
+
+
+@fixture
+def jwks():
+    return {'keys': [
+        oct_jwk('first', b'first-secret'), oct_jwk('second', b'2nd-secret')]}
+
+
+def test_parse_jwks(jwks):
+    keys = parse_jwks(json.dumps(jwks))
+    assert set(keys) == {('first', 'HS256'), ('second', 'HS256')}
+
+
+def test_decode_by_kid(jwks):
+    registry = KeyRegistry(jwks=json.dumps(jwks))
+    token = jwt.encode(
+        {'sub': 'me'}, 'secret', algorithm='HS256', headers={'kid': 'second'})
+    with raises(JWTError):
+        registry.decode(token)
+
+    token = jwt.encode(
+        {'sub': 'me'}, '2nd-secret', algorithm='HS256',
+        headers={'kid': 'second'})
+    assert registry.decode(token) == {'sub': 'me'}
+
+
+def test_unknown_kid(jwks):
+    registry = KeyRegistry(jwks=jwks)
+    token = jwt.encode(
+        {'sub': 'me'}, 'first-secret', algorithm='HS256',
+        headers={'kid': 'third'})
+    with raises(JWTError):
+        registry.decode(token)
+
+
+def test_plain_secret():
+    registry = KeyRegistry(jwks='plain-secret')
+    token = jwt.encode({'sub': 'me'}, 'plain-secret', algorithm='HS256')
+    assert registry.decode(token) == {'sub': 'me'}
+
+
+def test_url_refresh(app, mocker, jwks):
+    mock_get = mocker.patch('map.authz.jwks.requests.get')
+    mock_get.return_value.json.return_value = {'keys': jwks['keys'][:1]}
+    with app.app_context():
+        registry = KeyRegistry(url='https://keycloak.example.org/certs')
+        registry.stop()
+        assert set(registry.keys) == {('first', 'HS256')}
+
+        # failed refresh retains last known good keys
+        mock_get.return_value.json.side_effect = ValueError
+        assert not registry.refresh()
+    assert set(registry.keys) == {('first', 'HS256')}
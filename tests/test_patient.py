@@ -1,4 +1,5 @@
 import json
+from couchdb.client import Row
 from pytest import fixture, raises
 import os
 
@@ -8,6 +9,9 @@ from map.couch.patient import (
     dbname_from_id,
     dbname_from_username,
 )
+from map.fakes import populate
+from map.fakes.hapi import operation_outcome
+from map.fhir import HapiRequest
 
 
 @fixture
@@ -44,3 +48,196 @@ def test_parse_identifier(pre_id_patient):
     assert username == 'ed2932436ea3444e95bed523275828cb'
     assert dbname == 'userdb-6564323933323433366561333434346539356265643532333237353832386362'
 
+
+def test_sync_related_resources(app, mocker):
+    careplan = {
+        'resourceType': 'CarePlan', 'id': '54', 'activity': [
+            {'detail': {'instantiatesCanonical': ['Questionnaire/7']}}]}
+    mocker.patch(
+        'map.couch.patient.CarePlan.documents', return_value=[careplan])
+
+    def find_bundle(resource_type, search_dict, elements=None):
+        assert search_dict == {'based-on': 'CarePlan/54'}
+        return {'resourceType': 'Bundle', 'entry': [{'resource': {
+            'resourceType': resource_type, 'id': '1'}}]}, 200
+
+    mocker.patch('map.fhir.HapiRequest.find_bundle', side_effect=find_bundle)
+    mocker.patch('map.fhir.HapiRequest.find_by_id', return_value=(
+        {'resourceType': 'Questionnaire', 'id': '7'}, 200))
+    mock_sync = mocker.patch(
+        'map.couch.patient.CouchPatientDB.sync_documents',
+        side_effect=lambda docs: docs)
+
+    patient = CouchPatientDB({'resourceType': 'Patient', 'id': '12'})
+    with app.app_context():
+        patient.sync_related_resources()
+
+    synced = [
+        doc['resourceType']
+        for c in mock_sync.call_args_list for doc in c[0][0]]
+    assert synced == [
+        'CarePlan', 'Procedure', 'Questionnaire', 'QuestionnaireResponse']
+
+
+def test_sync_ignores_unrelated(app, fake_hapi, fake_couch):
+    ids = populate(fake_hapi, patients=2, careplans=1)
+    patient_id, other_id = ids['Patient']
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', patient_id)
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync()
+        db = fake_couch[patient.userdbname]
+
+        # another patient, forged in this patient's db with a newer date
+        other = fake_hapi.get('Patient', other_id)
+        forged = dict(other, active=False, meta={
+            'lastUpdated': '2999-01-01T00:00:00+00:00'})
+        db.put(f"Patient/{other_id}", forged)
+        CouchPatientDB(patient.patient_fhir).sync()
+
+    assert fake_hapi.get('Patient', other_id) == other
+
+
+def test_patient_resync(app, fake_hapi, fake_couch, mocker):
+    ids = populate(
+        fake_hapi, patients=2, careplans=4, questionnaires=3,
+        resources_per_careplan=2)
+    patient_id = ids['Patient'][0]
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', patient_id)
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync()
+        db = fake_couch[patient.userdbname]
+
+        # newer in couch; pushed to HAPI
+        qr_key = f"QuestionnaireResponse/{ids['QuestionnaireResponse'][0]}"
+        qr = dict(db.docs[qr_key], status='amended')
+        qr['meta'] = dict(qr['meta'], lastUpdated='2999-01-01T00:00:00+00:00')
+        db.put(qr_key, qr)
+
+        # all documents synced in a few, bulk, round trips; couch
+        # documents read by key, from the primary index
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', patient_id)
+        count = db.request_count
+        view = mocker.spy(db, 'view')
+        find = mocker.spy(db, 'find')
+        CouchPatientDB(patient_fhir).sync()
+        assert db.request_count - count <= 8
+        assert any(qr_key in c[1]['keys'] for c in view.call_args_list)
+        assert not find.called
+
+    assert fake_hapi.get(
+        'QuestionnaireResponse', qr['id'])['status'] == 'amended'
+
+
+def test_sync_conflict(app, fake_hapi, fake_couch, mocker):
+    ids = populate(fake_hapi, patients=1, careplans=1)
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', ids['Patient'][0])
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync_patient()
+        db = fake_couch[patient.userdbname]
+        careplan = fake_hapi.get('CarePlan', ids['CarePlan'][0])
+        key = f"CarePlan/{careplan['id']}"
+
+        # another writer stores the document between read and write
+        update = db.update
+
+        def racing_update(documents, **options):
+            if key not in db.docs:
+                db.put(key, dict(careplan, meta={
+                    'lastUpdated': '2000-01-01T00:00:00+00:00'}))
+            return update(documents, **options)
+
+        mocker.patch.object(db, 'update', side_effect=racing_update)
+        best = patient.sync_documents([careplan])
+
+    assert db.update.call_count == 2
+    assert best[0]['_rev'] == db.docs[key]['_rev']
+    assert db.docs[key]['meta'] == careplan['meta']
+
+
+def test_incremental_sync(app, fake_hapi, fake_couch):
+    ids = populate(
+        fake_hapi, patients=1, careplans=2, questionnaires=3,
+        resources_per_careplan=2)
+    patient_id = ids['Patient'][0]
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', patient_id)
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync()
+        db = fake_couch[patient.userdbname]
+        watermark = db.docs['_local/sync']
+        assert set(watermark['careplans']) == set(['54'] + ids['CarePlan'])
+
+        # unchanged patient: a single HAPI request, no couch writes
+        patient.sync()
+        hapi_count, seq = fake_hapi.request_count, db.seq
+        patient = CouchPatientDB(patient.patient_fhir)
+        patient.sync()
+        assert fake_hapi.request_count - hapi_count == 1
+        assert db.seq == seq
+
+        # changes on either side since the watermark are synced
+        proc = fake_hapi.get('Procedure', ids['Procedure'][0])
+        proc['status'] = 'completed'
+        fake_hapi.store(proc)
+        qr_key = f"QuestionnaireResponse/{ids['QuestionnaireResponse'][0]}"
+        qr = dict(db.docs[qr_key], status='amended')
+        qr['meta'] = dict(qr['meta'], lastUpdated='2999-01-01T00:00:00+00:00')
+        db.put(qr_key, qr)
+        CouchPatientDB(patient.patient_fhir).sync()
+
+    assert db.docs[f"Procedure/{proc['id']}"]['status'] == 'completed'
+    assert fake_hapi.get(
+        'QuestionnaireResponse', qr['id'])['status'] == 'amended'
+
+
+def test_watermark_ignores_device_clocks(app, fake_hapi, fake_couch, mocker):
+    ids = populate(
+        fake_hapi, patients=1, careplans=1, questionnaires=1,
+        resources_per_careplan=1)
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', ids['Patient'][0])
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync()
+        db = fake_couch[patient.userdbname]
+        qr_key = f"QuestionnaireResponse/{ids['QuestionnaireResponse'][0]}"
+        qr = dict(db.docs[qr_key], status='amended')
+        qr['meta'] = dict(qr['meta'], lastUpdated='2999-01-01T00:00:00+00:00')
+        db.put(qr_key, qr)
+
+        # HAPI refuses the couch newer document
+        handle = fake_hapi.handle
+
+        def failing_put(method, path, *args, **kwargs):
+            if method == 'PUT':
+                return operation_outcome(500, "unavailable")
+            return handle(method, path, *args, **kwargs)
+
+        mocker.patch.object(fake_hapi, 'handle', side_effect=failing_put)
+        CouchPatientDB(patient.patient_fhir).sync()
+
+    assert db.docs['_local/sync']['last_updated'] < '2999'
+
+
+def test_sync_document_deleted_in_couch(app, fake_hapi, fake_couch, mocker):
+    ids = populate(fake_hapi, patients=1, careplans=1)
+    with app.app_context():
+        patient_fhir, _ = HapiRequest.find_by_id('Patient', ids['Patient'][0])
+        patient = CouchPatientDB(patient_fhir)
+        patient.sync_patient()
+        db = fake_couch[patient.userdbname]
+        careplan = fake_hapi.get('CarePlan', ids['CarePlan'][0])
+        key = f"CarePlan/{careplan['id']}"
+
+        # a deleted document's row carries no body; HAPI's is restored
+        mocker.patch.object(db, 'view', return_value=[Row(
+            id=key, key=key, value={'rev': '2-x', 'deleted': True},
+            doc=None)])
+        count = fake_hapi.request_count
+        best = patient.sync_documents([dict(careplan)])
+
+    assert best[0]['id'] == careplan['id']
+    assert db.docs[key]['_rev'] != '2-x'
+    assert fake_hapi.request_count == count
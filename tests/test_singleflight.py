@@ -0,0 +1,40 @@
+from threading import Event, Thread
+import time
+
+from map.commons.singleflight import SingleFlight
+from map.fhir.hapi import canonical_search
+
+
+def test_concurrent_calls_share_result():
+    flight = SingleFlight()
+    release = Event()
+    calls = []
+
+    def slow_search():
+        calls.append(1)
+        release.wait()
+        return {'total': 1}
+
+    results = []
+
+    def caller():
+        results.append(flight.do('key', slow_search))
+
+    threads = [Thread(target=caller) for _ in range(4)]
+    for t in threads:
+        t.start()
+    while not flight._calls or flight._calls['key'].waiters < 3:
+        time.sleep(0.001)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{'total': 1}] * 4
+    # each caller gets its own copy
+    assert len(set(id(r) for r in results)) == 4
+
+
+def test_canonical_search():
+    assert canonical_search('CarePlan', {'_id': 54, 'a': ['y', 'x']}) == \
+        canonical_search('CarePlan', {'a': ('x', 'y'), '_id': '54'})
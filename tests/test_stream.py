@@ -0,0 +1,40 @@
+import json
+import os
+from pytest import fixture, raises
+
+from map.fhir.stream import iter_bundle_entries
+
+
+@fixture
+def careplan_bundle():
+    data_dir = os.path.join(os.path.dirname(__file__), 'test_bundle')
+    with open(os.path.join(data_dir, "careplan.json"), 'r') as json_file:
+        data = json.load(json_file)
+    return data
+
+
+def chunked(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def test_entries_across_chunks(careplan_bundle):
+    text = json.dumps(careplan_bundle, indent=2)
+    for size in (1, 7, 4096):
+        fields = {}
+        entries = list(iter_bundle_entries(chunked(text, size), fields))
+        assert entries == careplan_bundle['entry']
+        assert fields['total'] == careplan_bundle['total']
+        assert fields['link'] == careplan_bundle['link']
+
+
+def test_empty_bundle():
+    text = '{"resourceType": "Bundle", "total": 10, "entry": []}'
+    fields = {}
+    assert list(iter_bundle_entries(chunked(text, 3), fields)) == []
+    assert fields['total'] == 10
+
+
+def test_truncated_bundle(careplan_bundle):
+    text = json.dumps(careplan_bundle)[:-20]
+    with raises(ValueError):
+        list(iter_bundle_entries(chunked(text, 50)))
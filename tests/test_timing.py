@@ -0,0 +1,43 @@
+from map.couch.server import normalise_couch_path
+from map.fakes import populate
+from map.timing import RequestTiming, normalise_path
+
+
+def test_normalise_path():
+    assert normalise_path('Patient/12') == 'Patient/{id}'
+    assert normalise_path('Patient?identifier=a|b') == 'Patient'
+    assert normalise_path('http://h/fhir/?_getpages=1') == '_getpages'
+    assert normalise_couch_path(
+        'http://h:5984/userdb-6162/CarePlan%2F54') == 'userdb-{id}/{doc}'
+    assert normalise_couch_path('http://h:5984/_users') == '_users'
+
+
+def test_header():
+    timing = RequestTiming()
+    timing.record('hapi', 'GET', 'Patient/1', 200, 10, 0.010)
+    timing.record('hapi', 'GET', 'Patient/2', 200, 10, 0.020)
+    with timing.phase('auth'):
+        pass
+    header = timing.header()
+    assert 'hapi;dur=30.0;desc="2 calls"' in header
+    assert header.startswith('auth;dur=')
+    assert 'total;dur=' in header
+    assert timing.summary()['upstream_calls'] == 2
+
+
+def test_server_timing_header(client, fake_hapi, app):
+    populate(fake_hapi)
+    app.config['TIMING_LOG'] = True
+    results = client.get('/'.join((
+        app.config['API_PREFIX'], 'DocumentReference')))
+    assert results.status_code == 200
+    assert 'hapi;dur=' in results.headers['Server-Timing']
+
+
+def test_json_phase(client, fake_hapi, app):
+    populate(fake_hapi)
+    app.config['PASSTHROUGH_READS'] = False
+    results = client.get('/'.join((
+        app.config['API_PREFIX'], 'DocumentReference')))
+    assert results.status_code == 200
+    assert 'json;dur=' in results.headers['Server-Timing']